@@ -0,0 +1,264 @@
+import asyncio
+import fcntl
+import itertools
+import json
+import logging
+import os
+
+from app import mqtt_client
+
+logger = logging.getLogger(__name__)
+
+# Cluster-Modus für `uvicorn --workers N`: genau ein Prozess (Ingest) hält die MQTT-Verbindung
+# und verteilt Snapshot und Change-Sets über einen Unix-Socket an alle anderen Worker.
+# Welcher Prozess das ist, entscheidet eine Dateisperre; stirbt er, übernimmt ein Worker.
+# Einschalten mit MQTT_CLUSTER=1; Socket und Sperrdatei müssen für alle Worker derselbe Pfad sein
+# (relative Pfade werden beim Import absolut gemacht)
+CLUSTER_MODE = os.environ.get("MQTT_CLUSTER", "").lower() in ("1", "true", "yes")
+CLUSTER_SOCKET = os.path.abspath(os.environ.get("MQTT_CLUSTER_SOCKET", "mqtt_cluster.sock"))
+CLUSTER_LOCK = os.path.abspath(os.environ.get("MQTT_CLUSTER_LOCK", "mqtt_cluster.lock"))
+# Wartende Updates pro Worker; läuft die Queue über, verbindet sich der Worker neu (neuer Snapshot)
+WORKER_QUEUE_SIZE = 1000
+# Pause vor einem neuen Verbindungsversuch zum Ingest-Prozess (Sekunden)
+RECONNECT_DELAY = 0.5
+# Maximale Zeilenlänge im Socket-Protokoll (der Snapshot ist eine Zeile)
+STREAM_LIMIT = 64 * 1024 * 1024
+
+is_owner = False
+_lock_file = None
+_server = None
+_worker_task = None
+_background_tasks = set()
+
+# Worker: Verbindung zum Ingest-Prozess und weitergereichte Publishes
+# (id -> (Future, Ergebnis bei Verbindungsverlust))
+_writer = None
+_pending_publishes = {}
+_publish_ids = itertools.count(1)
+
+# Zuletzt kodiertes Update: alle Worker bekommen dasselbe Objekt, kodiert wird es nur einmal
+_last_encoded = (None, b"")
+
+
+def _encode(message: dict) -> bytes:
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+
+def _encode_update(update: dict) -> bytes:
+    global _last_encoded
+    if _last_encoded[0] is not update:
+        _last_encoded = (update, _encode(update))
+    return _last_encoded[1]
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _try_acquire_lock() -> bool:
+    global _lock_file
+    lock_file = open(CLUSTER_LOCK, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _lock_file = lock_file
+    return True
+
+
+# --- Ingest-Prozess ---
+
+
+async def _start_owner():
+    global is_owner, _server
+    is_owner = True
+    mqtt_client.remote_publisher = None
+    mqtt_client.collect_samples = True
+    mqtt_client.start_mqtt_client()
+
+    # Ein übrig gebliebener Socket gehört zu einem beendeten Ingest-Prozess (wir halten die Sperre)
+    if os.path.exists(CLUSTER_SOCKET):
+        os.unlink(CLUSTER_SOCKET)
+    _server = await asyncio.start_unix_server(_serve_worker, CLUSTER_SOCKET, limit=STREAM_LIMIT)
+    logger.info("Ingest-Prozess (pid %d): verteilt MQTT-Zustand über %s", os.getpid(), CLUSTER_SOCKET)
+
+
+async def _serve_worker(reader, writer):
+    # Alle Geräte: Snapshot mit {Geräte-ID: [Version, Zustand]}, danach Updates mit "device"
+    with mqtt_client.device_updates.subscription(maxsize=WORKER_QUEUE_SIZE, overflow="disconnect",
+                                                 stream="cluster") as updates:
+        snapshots = {device_id: device.store.snapshot for device_id, device in list(mqtt_client.devices.items())}
+        writer.write(_encode({"type": "snapshot", "boot_id": mqtt_client.boot_id,
+                              "devices": {device_id: [version, dict(data)]
+                                          for device_id, (version, data) in snapshots.items()}}))
+        versions = {device_id: version for device_id, (version, _) in snapshots.items()}
+        tasks = {asyncio.create_task(_send_updates(updates, writer, versions)),
+                 asyncio.create_task(_receive_commands(reader, writer))}
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if isinstance(task.exception(), mqtt_client.SubscriptionClosed):
+                    logger.warning("Worker zu langsam, Verbindung wird beendet.")
+                elif task.exception() is not None:
+                    logger.warning("Verbindung zum Worker beendet: %s", task.exception())
+        except asyncio.CancelledError:
+            # Beim Herunterfahren; asyncio wertet das Ergebnis des Handlers selbst aus
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+
+async def _send_updates(updates, writer, versions: dict):
+    while True:
+        update = await updates.get()
+        # Bereits im Snapshot enthalten (Geräte ohne Snapshot sind erst danach entstanden)
+        if update["version"] > versions.get(update["device"], 0):
+            writer.write(_encode_update(update))
+            await writer.drain()
+
+
+async def _receive_commands(reader, writer):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        command = json.loads(line)
+        if command["type"] == "publish":
+            _spawn(_publish_for_worker(command, writer))
+
+
+async def _publish_for_worker(command: dict, writer):
+    try:
+        status = await mqtt_client.send_message_status(command["topic"], command["payload"], command["qos"],
+                                                       command["retain"], command.get("timeout"))
+    except ValueError as e:
+        logger.error("Publish eines Workers abgelehnt: %s", e)
+        status = "failed"
+    # Der Worker erwartet je nach Aufruf den Zustellstatus oder nur True/False
+    result = status if command.get("status") else status == "delivered"
+    if not writer.is_closing():
+        writer.write(_encode({"type": "ack", "id": command["id"], "ok": result}))
+
+
+# --- Worker ---
+
+
+def _remote_publish(topic, payload, qos=0, retain=False, status=False, timeout=None) -> asyncio.Future:
+    """
+    Ersatz für mqtt_client.publish_message_async: der Ingest-Prozess sendet und bestätigt.
+    Mit status=True wird das Future mit dem Zustellstatus ("delivered", "queued", "failed") erfüllt.
+    """
+    future = asyncio.get_running_loop().create_future()
+    failed = "failed" if status else False
+    if _writer is None or _writer.is_closing():
+        logger.warning("Keine Verbindung zum Ingest-Prozess. Nachricht konnte nicht gesendet werden.")
+        future.set_result(failed)
+        return future
+
+    publish_id = next(_publish_ids)
+    _pending_publishes[publish_id] = (future, failed)
+    future.add_done_callback(lambda f: _pending_publishes.pop(publish_id, None))
+    _writer.write(_encode({"type": "publish", "id": publish_id, "topic": topic, "payload": payload,
+                           "qos": qos, "retain": retain, "status": status, "timeout": timeout}))
+    return future
+
+
+def _apply_snapshot(device_id: str, version: int, state: dict):
+    """
+    Gleicht den lokalen Zustand eines Geräts mit dem Snapshot des Ingest-Prozesses ab. Der Unterschied
+    wird als ein Update veröffentlicht, damit bereits verbundene SSE-Clients konsistent bleiben.
+    """
+    device = mqtt_client.get_device(device_id)
+    current = device.store.messages
+    changes = {k: v for k, v in state.items() if k not in current or current[k] != v}
+    removed = tuple(k for k in current if k not in state)
+    # Verpasste Change-Sets lassen sich nicht nachliefern: wiederaufnehmende Streams bekommen einen Snapshot
+    device.change_log.clear()
+    if changes or removed or version != device.store.version:
+        mqtt_client.apply_update({"type": "update", "version": version, "topics": [], "device": device_id,
+                                  "changes": changes, "removed": removed, "received_at": None})
+
+
+async def _receive_updates(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        message = json.loads(line)
+        if message["type"] == "update":
+            message["removed"] = tuple(message["removed"])
+            mqtt_client.apply_update(message)
+        elif message["type"] == "snapshot":
+            # Gleiche ETags auf allen Workern
+            mqtt_client.boot_id = message["boot_id"]
+            for device_id, (version, state) in message["devices"].items():
+                _apply_snapshot(device_id, version, state)
+        elif message["type"] == "ack":
+            future, _ = _pending_publishes.get(message["id"], (None, None))
+            if future is not None and not future.done():
+                future.set_result(message["ok"])
+
+
+async def _run_worker():
+    global _writer
+    while True:
+        # Ist der Ingest-Prozess weg, wird die Sperre frei und dieser Worker übernimmt
+        if _try_acquire_lock():
+            await _start_owner()
+            return
+        try:
+            reader, writer = await asyncio.open_unix_connection(CLUSTER_SOCKET, limit=STREAM_LIMIT)
+        except OSError:
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+
+        logger.info("Worker (pid %d): mit Ingest-Prozess verbunden", os.getpid())
+        _writer = writer
+        try:
+            await _receive_updates(reader)
+        except (ConnectionError, ValueError) as e:
+            logger.warning("Fehler in der Verbindung zum Ingest-Prozess: %s", e)
+        finally:
+            _writer = None
+            writer.close()
+            for future, failed in list(_pending_publishes.values()):
+                if not future.done():
+                    future.set_result(failed)
+        logger.warning("Verbindung zum Ingest-Prozess verloren")
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def start() -> bool:
+    """
+    Startet diesen Prozess als Ingest-Prozess (MQTT-Verbindung + Socket-Server) oder als Worker.
+    Gibt True zurück, wenn dieser Prozess die MQTT-Verbindung hält.
+    """
+    global _worker_task
+    if _try_acquire_lock():
+        await _start_owner()
+    else:
+        mqtt_client.remote_publisher = _remote_publish
+        _worker_task = asyncio.create_task(_run_worker())
+    return is_owner
+
+
+def stop():
+    global _lock_file
+    if _worker_task is not None:
+        _worker_task.cancel()
+    if _server is not None:
+        _server.close()
+        if os.path.exists(CLUSTER_SOCKET):
+            os.unlink(CLUSTER_SOCKET)
+    if is_owner:
+        mqtt_client.stop_mqtt_client()
+    if _lock_file is not None:
+        fcntl.flock(_lock_file, fcntl.LOCK_UN)
+        _lock_file.close()
+        _lock_file = None
@@ -0,0 +1,119 @@
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from app import metrics
+
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
+
+# SSE-Streams komprimieren, wenn der Client es per Accept-Encoding anbietet
+SSE_COMPRESSION = True
+# zlib-Level 1-9 bzw. Brotli-Qualität 0-11; bei kleinen Events zählt vor allem das Wörterbuch
+SSE_COMPRESSION_LEVEL = 6
+SSE_BROTLI_QUALITY = 5
+# Speicher pro Verbindung: zlib-Fenster 2^15 (32 KiB) reicht für eine komplette Tabelle;
+# memLevel 8 ist der zlib-Standard (insgesamt ca. 256 KiB pro SSE-Client)
+SSE_ZLIB_MEMLEVEL = 8
+
+
+class _ZlibStream:
+    """gzip/deflate über einen zlib-Kontext, der für die ganze Verbindung erhalten bleibt."""
+
+    def __init__(self, encoding: str):
+        # wbits 31: gzip-Header, 15: zlib-Format (HTTP 'deflate')
+        wbits = 31 if encoding == "gzip" else 15
+        self._compressor = zlib.compressobj(SSE_COMPRESSION_LEVEL, zlib.DEFLATED, wbits, SSE_ZLIB_MEMLEVEL)
+
+    def chunk(self, data: bytes) -> bytes:
+        # Z_SYNC_FLUSH: der Client kann das Event sofort vollständig dekomprimieren,
+        # das Wörterbuch der bisherigen Events bleibt aber erhalten
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class _BrotliStream:
+    def __init__(self, encoding: str):
+        self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=SSE_BROTLI_QUALITY)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+# In Reihenfolge der Bevorzugung bei gleicher Gewichtung
+ENCODINGS = {"gzip": _ZlibStream, "deflate": _ZlibStream}
+if brotli is not None:
+    ENCODINGS = {"br": _BrotliStream, **ENCODINGS}
+
+
+def negotiate_encoding(accept_encoding: str):
+    """Bestes unterstütztes Content-Encoding aus einem Accept-Encoding-Header (oder None)."""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    def weight(encoding):
+        return weights.get(encoding, weights.get("*", 0.0))
+    # max() liefert bei Gleichstand das erste, also das bevorzugte Encoding
+    return max((encoding for encoding in ENCODINGS if weight(encoding) > 0), key=weight, default=None)
+
+
+class SseCompressionMiddleware:
+    """
+    ASGI-Middleware, die text/event-stream Antworten pro Verbindung inkrementell komprimiert.
+    Jedes Event (eine http.response.body Nachricht) wird sofort mit einem Sync-Flush gesendet;
+    der Kompressionskontext bleibt über alle Events erhalten, sodass wiederholtes Markup
+    (Tabellen, Formulare) nach dem ersten Event nur noch wenige Bytes kostet.
+    Andere Antworten werden unverändert durchgereicht.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not SSE_COMPRESSION:
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        stream = None
+
+        async def send_compressed(message):
+            nonlocal stream
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if headers.get("content-type", "").startswith("text/event-stream") \
+                        and "content-encoding" not in headers:
+                    stream = ENCODINGS[encoding](encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["content-length"]
+            elif message["type"] == "http.response.body" and stream is not None:
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                data = stream.chunk(body) if more_body else stream.finish(body)
+                metrics.sse_uncompressed_bytes.inc(encoding, amount=len(body))
+                metrics.sse_compressed_bytes.inc(encoding, amount=len(data))
+                message = {"type": "http.response.body", "body": data, "more_body": more_body}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,127 @@
+import json
+import logging
+import math
+
+from app.topics import TopicTrie
+
+logger = logging.getLogger(__name__)
+
+
+def parse_float(text):
+    """float() ohne nan/inf: solche Werte sind nicht JSON-kompatibel und zählen als nicht numerisch."""
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError(f"nicht endlicher Wert: {text!r}")
+    return value
+
+
+def _reject_constant(name):
+    raise ValueError(f"nicht endlicher Wert: {name}")
+
+
+def decode_value(topic, payload_str):
+    """Standard für Sensor-Topics: Text für die Anzeige, float (falls numerisch) für Zeitreihen."""
+    numeric = {}
+    try:
+        numeric[topic] = parse_float(payload_str)
+    except ValueError:
+        pass
+    return {topic: payload_str}, (), numeric
+
+
+def decode_innen(topic, payload_str):
+    """'innen' liefert 'Temperatur-Feuchte-Druck' und wird in indoor/* aufgeteilt."""
+    parts = payload_str.split('-')
+    if len(parts) != 3:
+        logger.warning("'innen' Topic Payload Formatfehler. Speichere original.", extra={"topic": topic})
+        # Speichere die Originalnachricht bei Formatfehler
+        return {topic: payload_str}, (), {}
+
+    changes = {}
+    numeric = {}
+    for key, part in zip(("indoor/temperature", "indoor/humidity", "indoor/pressure"), parts):
+        changes[key] = part.strip()
+        try:
+            numeric[key] = parse_float(part)
+        except ValueError:
+            pass
+    logger.debug("Topic 'innen' Daten '%s' verarbeitet.", payload_str, extra={"topic": topic})
+    # Entferne den ursprünglichen "innen" Topic, da er aufgeteilt wurde
+    return changes, (topic,), numeric
+
+
+def decode_settings(topic, payload_str):
+    """
+    'send_settings' enthält ein JSON-Objekt; jeder Eintrag wird als 'setting_KEY' gespeichert.
+    Einstellungen sind keine Messwerte und bekommen keine Zeitreihen.
+    """
+    # Rohen Payload für Anzeige speichern
+    changes = {"send_settings_payload": payload_str}
+    try:
+        # json.loads akzeptiert sonst auch NaN, Infinity und 1e999
+        settings_data = json.loads(payload_str, parse_float=parse_float, parse_constant=_reject_constant)
+    except ValueError as e:  # auch json.JSONDecodeError
+        logger.error("Beim Parsen des 'send_settings' JSON Payloads: %s. Speichere original unter '%s'.", e, topic,
+                     extra={"topic": topic})
+        changes[topic] = payload_str
+        return changes, (), {}
+
+    if not isinstance(settings_data, dict):
+        logger.warning("'send_settings' Payload ist kein JSON-Objekt. Speichere original unter '%s'.", topic,
+                       extra={"topic": topic})
+        changes[topic] = payload_str  # Fallback
+        return changes, (), {}
+
+    for key, value in settings_data.items():
+        changes[f"setting_{key}"] = value
+    logger.debug("Topic 'send_settings' Daten verarbeitet und als 'setting_KEY' gespeichert.", extra={"topic": topic})
+    return changes, (), {}
+
+
+# Topic (oder MQTT-Filter mit '+'/'#') -> Decoder; alle anderen Topics verwenden decode_value
+TOPIC_DECODERS = {
+    "innen": decode_innen,
+    "send_settings": decode_settings,
+}
+
+# Pro Topic einmal aufgelöster Decoder (Dispatch-Tabelle)
+_dispatch = {}
+# Wildcard-Filter aus TOPIC_DECODERS, nur für die erstmalige Auflösung eines Topics
+_wildcard_decoders = None
+
+
+def register_decoder(topic_filter, decoder):
+    global _wildcard_decoders
+    TOPIC_DECODERS[topic_filter] = decoder
+    _dispatch.clear()
+    _wildcard_decoders = None
+
+
+def _resolve_decoder(topic):
+    global _wildcard_decoders
+    decoder = TOPIC_DECODERS.get(topic)
+    if decoder is not None:
+        return decoder
+    if _wildcard_decoders is None:
+        _wildcard_decoders = TopicTrie()
+        for topic_filter, candidate in TOPIC_DECODERS.items():
+            if '+' in topic_filter or '#' in topic_filter:
+                _wildcard_decoders.insert(topic_filter, candidate)
+    candidates = _wildcard_decoders.match(topic)
+    return candidates[0] if candidates else decode_value
+
+
+def decode(topic, payload_str):
+    """
+    Gibt (Änderungen, entfernte Keys, numerische Werte) für eine Nachricht zurück.
+    Pro Nachricht: ein Dict-Lookup in der Dispatch-Tabelle plus ein Parse-Vorgang.
+    """
+    decoder = _dispatch.get(topic)
+    if decoder is None:
+        decoder = _dispatch[topic] = _resolve_decoder(topic)
+    try:
+        return decoder(topic, payload_str)
+    except Exception as e:
+        logger.error("Beim Verarbeiten des '%s' Payloads '%s': %s. Speichere original.", topic, payload_str, e,
+                     extra={"topic": topic})
+        return {topic: payload_str}, (), {}
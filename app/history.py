@@ -0,0 +1,156 @@
+from array import array
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Zeitreihe fester Kapazität: Zeitstempel (Unix-Sekunden) und Werte liegen kompakt
+    in zwei array('d'). Die Arrays wachsen erst mit den Werten bis zur Kapazität (selten
+    gesendete Topics belegen so kaum Speicher); ist der Puffer voll, überschreibt jeder
+    neue Wert den ältesten.
+    Zeitstempel werden in aufsteigender Reihenfolge angehängt, daher lassen sich
+    Zeitbereiche per Binärsuche in O(log n) finden.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._timestamps = array('d')
+        self._values = array('d')
+        self._start = 0  # physischer Index des ältesten Eintrags
+        self._size = 0
+        self.appended = 0  # Anzahl aller jemals angehängten Werte (z.B. für Cache-Keys)
+
+    def __len__(self):
+        return self._size
+
+    def append(self, timestamp: float, value: float):
+        self.appended += 1
+        if self._size < self.capacity:
+            # Noch nicht voll: _start ist 0, die Arrays wachsen (amortisiert O(1))
+            self._timestamps.append(timestamp)
+            self._values.append(value)
+            self._size += 1
+            return
+        self._timestamps[self._start] = timestamp
+        self._values[self._start] = value
+        self._start = (self._start + 1) % self.capacity
+
+    @property
+    def oldest(self):
+        """Zeitstempel des ältesten Eintrags (None, wenn leer)."""
+        return self._timestamps[self._start] if self._size else None
+
+    @property
+    def newest(self):
+        """Zeitstempel des neuesten Eintrags (None, wenn leer)."""
+        return self._timestamps[(self._start + self._size - 1) % self.capacity] if self._size else None
+
+    def _bisect(self, timestamp: float) -> int:
+        """Logischer Index des ersten Eintrags mit Zeitstempel >= timestamp."""
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamps[(self._start + mid) % self.capacity] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _bisect_right(self, timestamp: float) -> int:
+        """Logischer Index des ersten Eintrags mit Zeitstempel > timestamp."""
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamps[(self._start + mid) % self.capacity] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _slice(self, data: array, first: int, last: int) -> array:
+        """Kopiert die logischen Indizes [first, last) zusammenhängend heraus."""
+        begin = self._start + first
+        end = self._start + last
+        if end <= self.capacity:
+            return data[begin:end]
+        if begin >= self.capacity:
+            return data[begin - self.capacity:end - self.capacity]
+        return data[begin:] + data[:end - self.capacity]
+
+    def range(self, start: float = None, end: float = None):
+        """Gibt (Zeitstempel, Werte) aller Einträge mit start <= Zeitstempel <= end zurück."""
+        first = 0 if start is None else self._bisect(start)
+        last = self._size if end is None else self._bisect_right(end)
+        if first >= last:
+            return array('d'), array('d')
+        return self._slice(self._timestamps, first, last), self._slice(self._values, first, last)
+
+
+def aggregate_buckets(timestamps: array, values: array, start: float, end: float, buckets: int):
+    """
+    Teilt [start, end] in `buckets` gleich lange Zeitfenster und berechnet pro nicht-leerem
+    Fenster min/max/mean vektorisiert (np.*.reduceat über die sortierten Zeitstempel).
+    Gibt (Fensteranfang, min, max, mean) als NumPy-Arrays zurück.
+    """
+    ts = np.frombuffer(timestamps, dtype=np.float64)
+    vs = np.frombuffer(values, dtype=np.float64)
+    edges = np.linspace(start, end, buckets + 1)
+    # Grenzindizes der Fenster; leere Fenster (gleicher Start- und Endindex) weglassen
+    first = np.searchsorted(ts, edges, side="left")
+    first[-1] = np.searchsorted(ts, end, side="right")
+    non_empty = first[1:] > first[:-1]
+    starts = first[:-1][non_empty] - first[0]
+    counts = first[1:][non_empty] - first[:-1][non_empty]
+    vs = vs[first[0]:first[-1]]
+    if vs.size == 0:
+        empty = np.empty(0)
+        return empty, empty, empty, empty
+    return (edges[:-1][non_empty],
+            np.minimum.reduceat(vs, starts),
+            np.maximum.reduceat(vs, starts),
+            np.add.reduceat(vs, starts) / counts)
+
+
+def lttb(timestamps: array, values: array, max_points: int):
+    """
+    Largest-Triangle-Three-Buckets Downsampling auf höchstens `max_points` Punkte.
+    Die Mittelwerte aller Buckets werden vektorisiert berechnet (np.add.reduceat). Die Auswahl
+    hängt vom zuvor gewählten Punkt ab und läuft daher sequentiell, aber über Python-Floats:
+    das ist bei kleinen Buckets deutlich schneller als ein NumPy-Aufruf pro Bucket.
+    """
+    ts = np.frombuffer(timestamps, dtype=np.float64)
+    vs = np.frombuffer(values, dtype=np.float64)
+    n = ts.size
+    if n <= max_points or max_points < 3:
+        return ts.copy(), vs.copy()
+
+    # Innere Buckets zwischen erstem und letztem Punkt; der letzte Punkt ist der "nächste Bucket"
+    # des letzten inneren Buckets
+    bounds = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    starts = bounds[1:]
+    counts = np.diff(np.append(starts, n))
+    # Zeiten relativ zum ersten Punkt, sonst verlieren die Flächen bei Unix-Zeitstempeln an Genauigkeit
+    rel_ts = ts - ts[0]
+    avg_t = (np.add.reduceat(rel_ts, starts) / counts).tolist()
+    avg_v = (np.add.reduceat(vs, starts) / counts).tolist()
+    t = rel_ts.tolist()
+    v = vs.tolist()
+    limits = bounds.tolist()
+
+    selected = [0]
+    previous = 0
+    for i in range(max_points - 2):
+        # Fläche des Dreiecks (A, Punkt, Mittelwert des nächsten Buckets), ohne Faktor 1/2
+        t_a, v_a = t[previous], v[previous]
+        a = t_a - avg_t[i]
+        b = avg_v[i] - v_a
+        c = avg_t[i] * v_a - t_a * avg_v[i]
+        best = -1.0
+        for j in range(limits[i], limits[i + 1]):
+            area = abs(v[j] * a + t[j] * b + c)
+            if area > best:
+                best, previous = area, j
+        selected.append(previous)
+    selected.append(n - 1)
+    return ts[selected], vs[selected]
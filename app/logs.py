@@ -0,0 +1,133 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Ab diesem Level wird geloggt; darunter kosten Log-Aufrufe nur einen Level-Vergleich
+LOG_LEVEL = logging.INFO
+# "text" oder "json" (ein JSON-Objekt pro Zeile)
+LOG_FORMAT = "text"
+# Höchstens so viele Einträge pro Topic und Sekunde (0 = keine Begrenzung)
+TOPIC_LOG_RATE = 5
+# Einträge, die höchstens auf den Writer-Thread warten; darüber hinaus wird verworfen
+LOG_QUEUE_SIZE = 10000
+
+# Attribute, die jeder LogRecord hat; alles andere kam über `extra=` und wird mit ausgegeben
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class TopicSampler(logging.Filter):
+    """
+    Begrenzt Einträge mit `extra={"topic": ...}` auf TOPIC_LOG_RATE pro Topic und Sekunde.
+    Läuft im aufrufenden Thread vor dem Einreihen: verworfene Einträge erreichen die Queue nie.
+    Der erste Eintrag eines neuen Zeitfensters trägt die Anzahl der zuvor unterdrückten.
+    Warnungen und Fehler werden nie unterdrückt.
+    """
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self._windows = {}  # topic -> [Sekunde, Anzahl, unterdrückt]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        topic = getattr(record, "topic", None)
+        if topic is None or not self.rate or record.levelno >= logging.WARNING:
+            return True
+        second = int(record.created)
+        window = self._windows.get(topic)
+        if window is None or window[0] != second:
+            if window is not None and window[2]:
+                record.suppressed = window[2]
+            self._windows[topic] = [second, 1, 0]
+            return True
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    Reiht Einträge nur ein; Formatieren und Schreiben übernimmt der QueueListener-Thread.
+    Die Argumente werden erst dort eingesetzt und dürfen danach nicht mehr verändert werden
+    (gilt für die Change-Sets, die ohnehin unveränderlich sind).
+    Ist die Queue voll, wird der Eintrag verworfen statt den Aufrufer zu blockieren.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        if getattr(record, "suppressed", 0):
+            line += f" (+{record.suppressed} unterdrückt)"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging():
+    """Leitet alle Logger unter 'app' über eine Queue an einen Writer-Thread (stdout)."""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = BackgroundQueueHandler(log_queue)
+    handler.addFilter(TopicSampler(TOPIC_LOG_RATE))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+
+    logger = logging.getLogger("app")
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(handler)
+    logger.propagate = False
+
+
+def stop_logging():
+    """Schreibt die noch wartenden Einträge und beendet den Writer-Thread."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    logger = logging.getLogger("app")
+    for handler in list(logger.handlers):
+        if isinstance(handler, BackgroundQueueHandler):
+            logger.removeHandler(handler)
+            if handler.dropped:
+                print(f"LOGGING: {handler.dropped} Einträge wegen voller Queue verworfen", file=sys.stderr)
+    logger.propagate = True
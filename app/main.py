@@ -1,27 +1,322 @@
 import asyncio
-from fastapi import FastAPI, Request, HTTPException, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import Depends, FastAPI, Request, HTTPException, Form, Query
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import html  # Importiere das html Modul für escaping
+import collections
 import json
+import logging
+import os
+import time
+import urllib.parse
+from typing import List, Optional
+import numpy as np
+from pydantic import BaseModel, Field
 from sse_starlette.sse import EventSourceResponse
+from starlette.concurrency import run_in_threadpool
+from app import cluster, history, logs, metrics, topics
+from app.compression import SseCompressionMiddleware
+from app.outbox import OUTBOX_SIZE
+from app import settings_cache as settings_caches
+from app.settings_cache import settings_cache
 from app import mqtt_client  # Ihre mqtt_client.py Datei
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI()
+# SSE-Streams pro Verbindung komprimieren (gzip/deflate, mit dem Paket 'brotli' auch br)
+app.add_middleware(SseCompressionMiddleware)
 
 # Templates und Static Files konfigurieren
 templates = Jinja2Templates(directory="app/templates")
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
+
+class FragmentCache:
+    """
+    Cache für gerenderte HTML-Fragmente eines Geräts, versioniert über die Snapshot-Version
+    seines StateStores. Das erste Rendering einer Version wird von allen SSE-Streams und
+    Seitenaufrufen wiederverwendet, statt das Template pro Client neu zu rendern.
+    `context` enthält zusätzliche Template-Variablen (z.B. url_prefix der Geräte-Routen).
+    Keys hängen von ?filter= Kombinationen und geänderten Zeilen ab; höchstens `maxsize`
+    Einträge werden gehalten, der am längsten nicht benutzte fällt heraus (LRU).
+    """
+
+    def __init__(self, device: mqtt_client.Device = None, context: dict = None, maxsize: int = 256):
+        self.device = device or mqtt_client.default_device
+        self.context = context or {}
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()  # key -> (version, html)
+
+    def get(self, key, version: int, render) -> str:
+        """Liefert das Fragment `key` für `version`; render() wird nur beim ersten Zugriff aufgerufen."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        started = time.perf_counter()
+        html_fragment = render()
+        metrics.template_render_seconds.observe(time.perf_counter() - started, key[0])
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < version:
+            self._entries[key] = (version, html_fragment)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return html_fragment
+
+    def render(self, template_name: str, data_name: str, topic_filters: tuple = None) -> str:
+        """
+        Rendert template_name mit den letzten Nachrichten als `data_name` (oder liefert den Cache).
+        Mit topic_filters nur die passenden Keys; jede Filter-Kombination hat ihren eigenen Eintrag.
+        """
+        version, data = self.device.store.snapshot
+
+        def render():
+            return templates.get_template(template_name).render(
+                dict(self.context, **{data_name: filter_messages(data, topic_filters)}))
+        return self.get((template_name, topic_filters), version, render)
+
+
+fragment_cache = FragmentCache(context={"url_prefix": ""})
+# Geräte-ID -> FragmentCache; ein Update eines Geräts macht nur dessen Fragmente ungültig
+_device_fragment_caches = {mqtt_client.DEFAULT_DEVICE: fragment_cache}
+
+
+def device_url_prefix(device: mqtt_client.Device) -> str:
+    """Präfix der Routen eines Geräts ('' für das Standardgerät, sonst '/devices/<id>')."""
+    if device is mqtt_client.default_device:
+        return ""
+    return "/devices/" + urllib.parse.quote(device.id, safe="")
+
+
+def device_fragment_cache(device: mqtt_client.Device = None) -> FragmentCache:
+    """FragmentCache eines Geräts (ohne Gerät: Standardgerät), beim ersten Zugriff angelegt."""
+    if device is None:
+        return fragment_cache
+    cache = _device_fragment_caches.get(device.id)
+    if cache is None:
+        cache = _device_fragment_caches[device.id] = FragmentCache(
+            device, {"url_prefix": device_url_prefix(device)})
+    return cache
+
+
+def request_device(request: Request) -> mqtt_client.Device:
+    """
+    Dependency: das Gerät aus dem Pfad /devices/{device_id}/..., für alle anderen Routen das
+    Standardgerät. Unbekannte Geräte ergeben HTTP 404 (Geräte entstehen nur durch MQTT-Nachrichten).
+    """
+    device_id = request.path_params.get("device_id")
+    if device_id is None:
+        return mqtt_client.default_device
+    device = mqtt_client.devices.get(device_id)
+    if device is None:
+        raise HTTPException(status_code=404, detail=f"Unbekanntes Gerät '{device_id}'")
+    return device
+
+
+def mqtt_row_id(topic: str) -> str:
+    """
+    Stabile DOM-id der Dashboard-Zeile eines Topics. Zeichen außer [A-Za-z0-9_] werden
+    als '-<hex>' kodiert, z.B. 'esp32/temperature' -> 'mqtt-row-esp32-2ftemperature'.
+    """
+    return "mqtt-row-" + "".join(
+        c if c.isascii() and (c.isalnum() or c == "_") else f"-{ord(c):x}" for c in topic)
+
+
+def is_dashboard_topic(topic: str) -> bool:
+    """Einstellungen werden auf der Settings-Seite angezeigt, nicht in der Dashboard-Tabelle."""
+    return not topic.startswith('setting_') and topic != 'send_settings' and topic != 'send_settings_payload'
+
+
+def filter_messages(messages, topic_filters: tuple = None):
+    """Nur die Keys, die auf einen der MQTT-Filter passen (ohne Filter: alle)."""
+    if not topic_filters:
+        return messages
+    trie = topics.filter_trie(topic_filters)
+    return {k: v for k, v in messages.items() if trie.matches(k)}
+
+
+def parse_topic_filters(topic_filters) -> tuple:
+    """Query-Parameter ?filter=... prüfen; ungültige MQTT-Filter ergeben HTTP 400."""
+    if not topic_filters:
+        return None
+    for topic_filter in topic_filters:
+        if not topics.is_valid_filter(topic_filter):
+            raise HTTPException(status_code=400, detail=f"Ungültiger Topic-Filter '{topic_filter}'")
+    return tuple(sorted(set(topic_filters)))
+
+
+def parse_overflow(overflow: Optional[str]) -> Optional[str]:
+    """Query-Parameter ?overflow=... prüfen (None = mqtt_client.SUBSCRIBER_OVERFLOW)."""
+    if overflow is not None and overflow not in mqtt_client.OVERFLOW_POLICIES:
+        raise HTTPException(status_code=400, detail=f"Unbekannte Overflow-Policy '{overflow}'")
+    return overflow
+
+
+# --- ETAGS UND LONG-POLLING ---
+# ETags sind Zustandsversionen: gleiche Version bedeutet (auf allen Cluster-Workern) gleiche Daten.
+# Sie enthalten zusätzlich mqtt_client.boot_id, da Versionen nach einem Neustart ohne Datenbank
+# wieder bei 0 beginnen, und die optionale Build-Kennung, da ein Deployment bei gleicher Version
+# andere Antworten liefern kann.
+BUILD_ID = os.environ.get("BUILD_ID", "")
+# Längste Wartezeit für ?wait=N (Sekunden)
+LONG_POLL_MAX_WAIT = 60
+
+
+def state_etag(version: int) -> str:
+    prefix = f"{BUILD_ID}-" if BUILD_ID else ""
+    return f'"{prefix}{mqtt_client.boot_id}-v{version}"'
+
+
+def sse_event_id(version: int) -> str:
+    """SSE-id eines Events: wie die ETags nur zusammen mit mqtt_client.boot_id eindeutig."""
+    return f"{mqtt_client.boot_id}-{version}"
+
+
+def parse_event_id(event_id: str) -> Optional[int]:
+    """Version aus einer Last-Event-ID dieses Zustands-Ursprungs, sonst (anderer Start, ungültig) None."""
+    boot_id, _, version = event_id.rpartition("-")
+    if boot_id != mqtt_client.boot_id or not version.isdigit():
+        return None
+    return int(version)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True, wenn If-None-Match den ETag (oder '*') enthält."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def filtered_version(store: mqtt_client.StateStore, topic_filters: tuple = None) -> int:
+    """Letzte Änderung an einem der Keys, die auf topic_filters passen (ohne Filter: Zustandsversion)."""
+    if not topic_filters:
+        return store.version
+    trie = topics.filter_trie(topic_filters)
+    return max((version for key, version in store.key_versions.items() if trie.matches(key)), default=0)
+
+
+async def wait_for_version(request: Request, device: mqtt_client.Device, topic_filters: tuple, wait: float) -> int:
+    """
+    Liefert filtered_version(topic_filters). Kennt der Client diese Version bereits (If-None-Match)
+    und ist wait > 0, wird die Anfrage gehalten, bis sich ein passender Key ändert oder `wait`
+    Sekunden (höchstens LONG_POLL_MAX_WAIT) vergangen sind. Wartende Anfragen kosten nur ein
+    Abonnement, das über den TopicTrie ausschließlich passende Updates bekommt.
+    """
+    version = filtered_version(device.store, topic_filters)
+    if wait <= 0 or not etag_matches(request, state_etag(version)):
+        return version
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(wait, LONG_POLL_MAX_WAIT)
+    with device.update_hub.subscription(topic_filters, stream="long_poll") as updates:
+        while True:
+            # Erst nach dem Abonnieren erneut prüfen, sonst könnte eine Änderung verloren gehen
+            version = filtered_version(device.store, topic_filters)
+            remaining = deadline - loop.time()
+            if remaining <= 0 or not etag_matches(request, state_etag(version)):
+                return version
+            try:
+                await asyncio.wait_for(updates.get(), remaining)
+            except (asyncio.TimeoutError, mqtt_client.SubscriptionClosed):
+                return filtered_version(device.store, topic_filters)
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+templates.env.filters["row_id"] = mqtt_row_id
+templates.env.tests["dashboard_topic"] = is_dashboard_topic
+
+
+def render_mqtt_table(topic_filters: tuple = None, device: mqtt_client.Device = None) -> str:
+    return device_fragment_cache(device).render("components/mqtt_table.html", "mqtt_data", topic_filters)
+
+
+def render_mqtt_rows(update: dict, topic_filters: tuple = None, device: mqtt_client.Device = None) -> str:
+    """
+    Rendert die geänderten Dashboard-Zeilen eines Updates als htmx out-of-band Swaps.
+    Gefilterte Abonnements und zusammengefasste (conflated) Updates enthalten bei gleicher
+    Version unterschiedliche Keys, daher je Menge geänderter Zeilen ein Cache-Eintrag.
+    """
+    topics = sorted(topic for topic in update["changes"] if is_dashboard_topic(topic))
+
+    def render():
+        row_template = templates.get_template("components/mqtt_row.html")
+        return "".join(
+            row_template.render({"topic": topic, "message": update["changes"][topic], "oob": True})
+            for topic in topics)
+    return device_fragment_cache(device).get(("components/mqtt_row.html", tuple(topics)), update["version"], render)
+
+
+def render_settings_display(device: mqtt_client.Device = None) -> str:
+    return device_fragment_cache(device).render("components/settings_display.html", "settings_data")
+
+
+def render_settings_status(device: mqtt_client.Device = None) -> str:
+    cache = settings_caches.cache_for_device(device or mqtt_client.default_device)
+    received_at = cache.received_at
+    return templates.get_template("components/settings_status.html").render({
+        "pending": cache.pending,
+        "fresh": cache.is_fresh(),
+        "received_at": time.strftime("%H:%M:%S", time.localtime(received_at)) if received_at else None,
+    })
+
 # MQTT-Routen für ESP32-Steuerung
 @app.post("/mqtt/send/{topic}/{message}")
 async def send_mqtt_message(topic: str, message: str):
     """Sendet eine MQTT-Nachricht an das ESP32."""
     try:
         # Verwende die korrekte Methode aus mqtt_client.py
-        await mqtt_client.send_message(topic, message)
-        return {"status": "success", "topic": topic, "message": message}
+        status = await mqtt_client.send_message_status(topic, message)
+        if status == "failed":
+            return {"status": "error", "error": "Nachricht wurde nicht bestätigt"}
+        # "queued": offline gepuffert, wird nach dem Wiederverbinden gesendet
+        return {"status": "success" if status == "delivered" else status, "topic": topic, "message": message}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+
+class MqttCommand(BaseModel):
+    topic: str
+    payload: str
+    qos: int = Field(0, ge=0, le=2)
+    retain: bool = False
+
+
+# Höchstens so viele Nachrichten pro Sammelauftrag; Standard: so viele, wie offline in die Outbox passen
+BULK_MAX_ITEMS = int(os.environ.get("MQTT_BULK_MAX_ITEMS", OUTBOX_SIZE))
+
+
+@app.post("/mqtt/send-bulk")
+async def send_mqtt_messages_bulk(commands: List[MqttCommand]):
+    """
+    Sendet mehrere MQTT-Nachrichten in einem Request (gepipelined, in Reihenfolge).
+    Jeder Eintrag bekommt seinen eigenen Status; Einträge mit ungültigem Topic werden
+    nicht gesendet ("invalid"), die übrigen trotzdem.
+    Höchstens BULK_MAX_ITEMS Einträge (Umgebungsvariable MQTT_BULK_MAX_ITEMS, Standard 1000),
+    sonst HTTP 413.
+    """
+    if len(commands) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Höchstens {BULK_MAX_ITEMS} Nachrichten pro Request")
+    try:
+        valid = [c for c in commands if topics.is_valid_topic(c.topic)]
+        sent = iter(await mqtt_client.send_messages_status(
+            [(c.topic, c.payload, c.qos, c.retain) for c in valid]))
+        results = [next(sent) if topics.is_valid_topic(c.topic) else "invalid" for c in commands]
+        return {
+            "status": "error" if "failed" in results or "invalid" in results
+            else "queued" if "queued" in results else "success",
+            "results": [
+                {"topic": c.topic, "payload": c.payload, "delivered": status == "delivered", "delivery": status}
+                for c, status in zip(commands, results)
+            ],
+        }
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
@@ -31,48 +326,122 @@ async def send_led_message(message: str):
     """Sendet eine MQTT-Nachricht an die ESP32 LED."""
     try:
         topic = "esp32/output"
-        await mqtt_client.send_message(topic, message)
-        return {"status": "success", "topic": topic, "message": message}
+        status = await mqtt_client.send_message_status(topic, message)
+        if status == "failed":
+            return {"status": "error", "error": "Nachricht wurde nicht bestätigt"}
+        return {"status": "success" if status == "delivered" else status, "topic": topic, "message": message}
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
 @app.get("/mqtt/status")
-async def get_esp32_status():
-    """Gibt die aktuelle Statusmeldung zurück."""
+@app.get("/devices/{device_id}/mqtt/status")
+async def get_esp32_status(request: Request, wait: float = Query(0, ge=0),
+                           device: mqtt_client.Device = Depends(request_device)):
+    """
+    Gibt die aktuelle Statusmeldung zurück. Der ETag ändert sich nur mit der Statusmeldung;
+    passt If-None-Match, antwortet der Server mit 304. Mit ?wait=N (Sekunden) wartet er
+    vorher bis zu N Sekunden auf eine neue Statusmeldung (Long-Polling).
+    """
     try:
+        version = await wait_for_version(request, device, ("status",), wait)
+        etag = state_etag(version)
+        if etag_matches(request, etag):
+            return not_modified(etag)
         # Hole die Nachricht vom Topic "status"
-        message = mqtt_client.latest_messages.get("status", "Keine Statusmeldung verfügbar")
-        return {"message": message}
+        message = device.store.messages.get("status", "Keine Statusmeldung verfügbar")
+        return JSONResponse({"message": message}, headers={"ETag": etag, "Cache-Control": "no-cache"})
     except Exception as e:
         return {"error": str(e)}
 
+
+@app.get("/mqtt/snapshot")
+@app.get("/devices/{device_id}/mqtt/snapshot")
+async def get_mqtt_snapshot(request: Request,
+                            topic_filter: Optional[List[str]] = Query(None, alias="filter"),
+                            wait: float = Query(0, ge=0),
+                            device: mqtt_client.Device = Depends(request_device)):
+    """
+    Alle letzten Nachrichten als JSON mit der Zustandsversion, für Clients ohne SSE.
+    filter=ext1/# (mehrfach möglich): nur passende Topics; der ETag ändert sich dann auch nur
+    mit diesen. If-None-Match und ?wait=N wie bei /mqtt/status.
+    """
+    topic_filters = parse_topic_filters(topic_filter)
+    version = await wait_for_version(request, device, topic_filters, wait)
+    etag = state_etag(version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    messages = filter_messages(device.store.messages, topic_filters)
+    return JSONResponse({"version": version, "messages": dict(sorted(messages.items()))},
+                        headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Metriken im Prometheus-Textformat (Ingest, SSE-Fan-out, Rendering, Publish, Event Loop)."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Mit MQTT_START_DEGRADED=1 nimmt die App sofort Anfragen an und verbindet sich im Hintergrund mit dem
+# Broker (Daten und Befehle sind verfügbar, sobald die Verbindung steht; Befehle landen bis dahin in der Outbox)
+START_DEGRADED = os.environ.get("MQTT_START_DEGRADED", "").lower() in ("1", "true", "yes")
+
+
+async def warm_templates():
+    """Kompiliert alle Templates parallel vorab und rendert die Fragmente des aktuellen Zustands."""
+    loop = asyncio.get_running_loop()
+    names = templates.env.list_templates(extensions=["html"])
+    await asyncio.gather(*(loop.run_in_executor(None, templates.env.get_template, name) for name in names))
+    render_mqtt_table()
+    render_settings_display()
+    logger.info("%d Templates vorbereitet", len(names))
+
+
 # MQTT Client starten
 @app.on_event("startup")
 async def startup_event():
+    # Log-Ausgabe über einen eigenen Writer-Thread, bevor die ersten Nachrichten eintreffen
+    logs.setup_logging()
     try:
         mqtt_client.app_event_loop = asyncio.get_running_loop()
-        print("Starting MQTT client...")
-        mqtt_client.start_mqtt_client()
-        print("MQTT Client gestartet")
-        
-        # Warte kurz, damit die Verbindung hergestellt werden kann
-        await asyncio.sleep(1)
-        
-        # Prüfe, ob die Verbindung erfolgreich war
-        if mqtt_client.client.is_connected():
-            print("MQTT Client erfolgreich verbunden")
+        # Referenz halten, sonst kann der Task vom Garbage Collector eingesammelt werden
+        app.state.loop_lag_task = asyncio.create_task(metrics.monitor_event_loop_lag())
+        settings_cache.start()
+        if cluster.CLUSTER_MODE and not await cluster.start():
+            # Worker: Zustand und Publishes laufen über den Ingest-Prozess
+            logger.info("Cluster-Worker gestartet")
+            await warm_templates()
+            return
+
+        logger.info("Starting MQTT client...")
+        if not cluster.CLUSTER_MODE:
+            mqtt_client.start_mqtt_client(background=START_DEGRADED)
+        logger.info("MQTT Client gestartet")
+        if START_DEGRADED:
+            await warm_templates()
+            logger.info("Start ohne Broker-Verbindung, Verbindung wird im Hintergrund aufgebaut")
+            return
+
+        # Templates vorbereiten, während auf das CONNACK des Brokers gewartet wird
+        connected, _ = await asyncio.gather(mqtt_client.wait_until_connected(), warm_templates())
+        if connected:
+            logger.info("MQTT Client erfolgreich verbunden")
         else:
-            print("MQTT Client ist nicht verbunden!")
+            logger.error("MQTT Client ist nicht verbunden!")
             raise Exception("MQTT Client konnte nicht verbunden werden")
     except Exception as e:
-        print(f"Fehler beim Starten des MQTT Clients: {e}")
+        logger.error("Fehler beim Starten des MQTT Clients: %s", e)
         raise
 
 
 @app.on_event("shutdown")
 def shutdown_event():
-    mqtt_client.stop_mqtt_client()
-    print("FastAPI App heruntergefahren und MQTT Client gestoppt.")
+    if getattr(app.state, "loop_lag_task", None):
+        app.state.loop_lag_task.cancel()
+    settings_caches.stop_all()
+    if cluster.CLUSTER_MODE:
+        cluster.stop()
+    else:
+        mqtt_client.stop_mqtt_client()
+    logger.info("FastAPI App heruntergefahren und MQTT Client gestoppt.")
+    logs.stop_logging()
 
 # Index-Seite
 
@@ -84,48 +453,59 @@ async def read_root(request: Request):
 # --- SETTINGS SEITE (GET) ---
 
 
+# So lange wartet die Seite höchstens auf die Antwort des ESP32, bevor die bekannten
+# Einstellungen gerendert werden (0 = nicht warten); danach aktualisiert SSE die Anzeige
+SETTINGS_PAGE_WAIT = 0.5
+
+
 @app.get("/settings", response_class=HTMLResponse)
-async def get_settings_page(request: Request):
-    # Fordert die aktuellen Einstellungen vom ESP32 an
-    mqtt_client.publish_message("settings", "REQUEST_SETTINGS")
-    print("MQTT-Nachricht an Topic 'settings' gesendet, um ESP32-Einstellungen anzufordern.")
+@app.get("/devices/{device_id}/settings", response_class=HTMLResponse)
+async def get_settings_page(request: Request, device: mqtt_client.Device = Depends(request_device)):
+    # Fordert die Einstellungen nur an, wenn sie veraltet sind; gleichzeitige Seitenaufrufe
+    # teilen sich eine laufende Anfrage
+    received = settings_caches.cache_for_device(device).request()
+    if not received.done() and SETTINGS_PAGE_WAIT > 0:
+        try:
+            await asyncio.wait_for(asyncio.shield(received), SETTINGS_PAGE_WAIT)
+        except asyncio.TimeoutError:
+            pass
     # Zeigt die zuletzt bekannten Einstellungen an, bis ein Update via SSE kommt.
-    # Annahme: Settings sind Teil von latest_messages, und der ESP sendet sie nach REQUEST_SETTINGS.
-
-    with mqtt_client.latest_messages_lock:
-        # Annahme: Settings sind Teil von latest_messages
-        current_settings_data = mqtt_client.latest_messages.copy()
     return templates.TemplateResponse("settings.html", {
         "request": request,
-        "settings_data": current_settings_data
+        "device": device,
+        "url_prefix": device_url_prefix(device),
+        "settings_html": render_settings_display(device),
+        "settings_status_html": render_settings_status(device),
     })
 
 # --- EINSTELLUNGEN ÄNDERN (POST via HTMX) ---
 
 
 @app.post("/htmx/change_esp_setting", response_class=HTMLResponse)
+@app.post("/devices/{device_id}/htmx/change_esp_setting", response_class=HTMLResponse)
 async def htmx_change_esp_setting_route(
     request: Request,
     parameter_name: str = Form(...),
-    new_value: str = Form(...)
+    new_value: str = Form(...),
+    device: mqtt_client.Device = Depends(request_device)
 ):
-    topic = "changeSetting"
+    topic = device.topic("changeSetting")
     message = f'["{parameter_name}"],["{new_value}"]'
 
-    print(f"FastAPI: Empfangene Einstellungsänderung via HTMX:")
-    print(f"  Parameter: {parameter_name}")
-    print(f"  Neuer Wert: {new_value}")
-    print(f"  Sende an MQTT Topic='{topic}', Message='{message}'")
+    logger.info("Empfangene Einstellungsänderung via HTMX: Parameter=%s, Neuer Wert=%s. "
+                "Sende an MQTT Topic='%s', Message='%s'", parameter_name, new_value, topic, message)
 
-    success = mqtt_client.publish_message(topic, message)
-    print(f"FastAPI: MQTT Nachricht gesendet: {success}")
+    status = await mqtt_client.send_message_status(topic, message)
+    logger.info("MQTT Nachricht gesendet: %s", status)
 
     # Die Rückgabe ist ein HTML-Fragment, das von HTMX in das target geladen wird
     # Normalerweise würde man hier das aktualisierte Fragment zurückgeben oder eine Erfolgs-/Fehlermeldung.
     # Der ESP32 sendet die neuen Settings dann via MQTT, was per SSE die Anzeige aktualisiert.
     # Daher reicht hier eine einfache Bestätigung.
-    if success is None or success is True:  # Annahme: publish_message gibt None oder True bei Erfolg zurück
+    if status == "delivered":
         return HTMLResponse(f"<span class='status-message success'>Änderung gesendet! Warte auf Bestätigung...</span>")
+    elif status == "queued":
+        return HTMLResponse(f"<span class='status-message success'>Keine Verbindung zum Broker - Änderung wird nach dem Wiederverbinden gesendet.</span>")
     else:
         return HTMLResponse(f"<span class='status-message error'>Fehler beim Senden der Änderung!</span>")
 
@@ -133,208 +513,345 @@ async def htmx_change_esp_setting_route(
 
 
 @app.get("/mqtt-dashboard", response_class=HTMLResponse)
-async def mqtt_dashboard_page(request: Request):
-    """Renders the MQTT dashboard page."""
-    with mqtt_client.latest_messages_lock:
-        initial_mqtt_data = mqtt_client.latest_messages.copy()
+@app.get("/devices/{device_id}/mqtt-dashboard", response_class=HTMLResponse)
+async def mqtt_dashboard_page(request: Request, device: mqtt_client.Device = Depends(request_device)):
+    """Renders the MQTT dashboard page (304, solange sich der Zustand nicht geändert hat)."""
+    etag = state_etag(device.store.version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
     return templates.TemplateResponse(
         "mqtt_dashboard.html",
-        {"request": request, "initial_mqtt_data": initial_mqtt_data}
+        {"request": request, "device": device, "url_prefix": device_url_prefix(device),
+         "mqtt_table_html": render_mqtt_table(device=device)},
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
     )
 
 # --- SSE GENERATOR FÜR MQTT DASHBOARD ---
 
 
-async def mqtt_dashboard_event_generator(request: Request):
-    """
-    Generiert SSE-Events für MQTT-Datenupdates für das Dashboard.
-    Liest von mqtt_client.update_queue.
-    """
-    # Variablen zur Vermeidung doppelter Verarbeitung durch diesen spezifischen Generator
-    global latest_message_html_fragment  # Access the shared variable
-    last_processed_update_content_for_dashboard = None
-
-    while True:
-        if await request.is_disconnected():
-            print("Client disconnected from MQTT Dashboard SSE")
-            break
-
-        # Um sicherzustellen, dass task_done nur aufgerufen wird, wenn ein Element geholt wurde
-        raw_update = None
-        try:
-            # Timeout für Keep-Alive
-            raw_update = await asyncio.wait_for(mqtt_client.update_queue.get(), timeout=30)
-
-            update_type = raw_update.get("type")
-            update_topic = raw_update.get("topic")
-            update_payload = raw_update.get("payload")
+def observe_latency(update: dict, stream: str):
+    """Erfasst die Zeit vom Empfang der (ältesten) MQTT-Nachricht bis zum Senden per SSE."""
+    received_at = update.get("received_at")
+    if received_at is not None:
+        metrics.ingest_to_sse_latency.observe(time.time() - received_at, stream)
 
-            # Erstelle einen eindeutigen Bezeichner für den Inhalt des Updates
-            current_update_content = (
-                update_type, update_topic, update_payload)
 
-            # Verarbeite nur, wenn sich der Inhalt seit dem letzten Mal geändert hat (für diesen Generator)
-            if current_update_content == last_processed_update_content_for_dashboard:
-                mqtt_client.update_queue.task_done()
-                # Zurücksetzen, da verarbeitet (oder eher ignoriert als Duplikat)
-                raw_update = None
-                continue
+async def mqtt_dashboard_event_generator(request: Request, delta: bool = False, topic_filters: tuple = None,
+                                         overflow: str = None, device: mqtt_client.Device = None):
+    """
+    Generiert SSE-Events für MQTT-Datenupdates für das Dashboard.
+    Liest von einem eigenen Abonnement des UpdateHubs des Geräts (ohne Gerät: Standardgerät).
 
-            last_processed_update_content_for_dashboard = current_update_content
+    Im Delta-Modus wird die komplette Tabelle ('message') nur beim Verbinden und zur
+    Resynchronisation gesendet (neue oder entfernte Zeilen); sonst werden nur die
+    geänderten Zeilen als out-of-band Swaps ('rows') übertragen.
+    Mit topic_filters (MQTT-Wildcards) erhält der Client nur die passenden Topics.
+    """
+    # Zuletzt gesendete Zustandsversion, um doppelte Verarbeitung zu vermeiden
+    last_sent_version = None
+    # Im Delta-Modus: Topics, deren Zeilen der Client aktuell anzeigt
+    shown_topics = set()
+
+    device = device or mqtt_client.default_device
+    with device.update_hub.subscription(topic_filters, overflow=overflow, stream="dashboard") as updates:
+        if delta:
+            last_sent_version, messages = device.store.snapshot
+            shown_topics = {topic for topic in filter_messages(messages, topic_filters) if is_dashboard_topic(topic)}
+            yield {"event": "message", "data": render_mqtt_table(topic_filters, device)}
 
-            # Das Dashboard soll alle Änderungen in `latest_messages` widerspiegeln.
-            # Wir rendern die Tabelle neu, wenn ein beliebiges Update aus der Queue kommt,
-            # das nicht explizit nur für die Settings-Seite gedacht ist (obwohl die Konkurrenz um die Queue bleibt).
-            # Eine einfachere Annahme: Jedes Update in der Queue könnte für das Dashboard relevant sein.
+        while True:
+            if await request.is_disconnected():
+                logger.debug("Client disconnected from MQTT Dashboard SSE")
+                break
 
-            print(f"MQTT Dashboard SSE: Update aus Queue: {raw_update}")
-            with mqtt_client.latest_messages_lock:
-                current_mqtt_data = mqtt_client.latest_messages.copy()
+            try:
+                # Timeout für Keep-Alive
+                raw_update = await asyncio.wait_for(updates.get(), timeout=30)
+
+                if delta:
+                    # Bereits in einer gesendeten Tabelle enthalten
+                    if raw_update["version"] <= last_sent_version:
+                        continue
+                    changed = {topic for topic in raw_update["changes"] if is_dashboard_topic(topic)}
+                    removed = {topic for topic in raw_update["removed"] if is_dashboard_topic(topic)}
+                    if updates.needs_resync() or removed & shown_topics or not changed <= shown_topics:
+                        # Updates verworfen (drop_oldest) oder Zeilen kommen hinzu bzw. fallen weg:
+                        # komplette Tabelle neu senden
+                        last_sent_version, messages = device.store.snapshot
+                        shown_topics = {topic for topic in filter_messages(messages, topic_filters)
+                                        if is_dashboard_topic(topic)}
+                        observe_latency(raw_update, "dashboard")
+                        yield {"event": "message", "data": render_mqtt_table(topic_filters, device)}
+                    elif changed:
+                        last_sent_version = raw_update["version"]
+                        observe_latency(raw_update, "dashboard")
+                        yield {"event": "rows", "data": render_mqtt_rows(raw_update, topic_filters, device)}
+                    continue
 
-            html_fragment = templates.get_template("components/mqtt_table.html").render({
-                "request": request,
-                "mqtt_data": current_mqtt_data
-            })
-            yield {"event": "message", "data": html_fragment}
+                # Verarbeite nur, wenn sich der Zustand seit dem letzten Senden geändert hat
+                # (mehrere Updates in der Queue können bereits in einer Version enthalten sein)
+                if device.store.version == last_sent_version:
+                    continue
+                last_sent_version = device.store.version
 
-            mqtt_client.update_queue.task_done()
-            raw_update = None  # Zurücksetzen nach erfolgreicher Verarbeitung
+                # Das Dashboard soll alle Änderungen im StateStore des Geräts widerspiegeln.
+                # Jede Verbindung hat ihr eigenes Abonnement und sieht daher jedes Update.
+                logger.debug("MQTT Dashboard SSE: Update aus Queue: %s", raw_update)
+                observe_latency(raw_update, "dashboard")
+                yield {"event": "message", "data": render_mqtt_table(topic_filters, device)}
 
-        except asyncio.TimeoutError:
-            yield {"event": "keep-alive", "data": "mqtt_dashboard_keep_alive"}
-        except asyncio.CancelledError:
-            print("MQTT Dashboard SSE connection closed by client.")
-            break  # Wichtig, um die Schleife zu beenden
-        except Exception as e:
-            print(f"Error in MQTT Dashboard SSE event_generator: {e}")
-            await asyncio.sleep(1)  # Kurze Pause vor dem nächsten Versuch
-        finally:
-            # Stellen Sie sicher, dass task_done aufgerufen wird, wenn ein Element erfolgreich
-            # aus der Queue geholt wurde, aber während der Verarbeitung ein Fehler auftrat.
-            if raw_update is not None:  # pragma: no cover
-                # Dies wird erreicht, wenn get() erfolgreich war, aber später ein Fehler auftrat
-                # bevor task_done() im try-Block erreicht wurde.
-                try:
-                    mqtt_client.update_queue.task_done()
-                except ValueError:  # Falls task_done schon gerufen wurde oder nicht nötig
-                    pass
+            except asyncio.TimeoutError:
+                yield {"event": "keep-alive", "data": "mqtt_dashboard_keep_alive"}
+            except mqtt_client.SubscriptionClosed:
+                logger.warning("MQTT Dashboard SSE: Client zu langsam, Verbindung wird beendet.")
+                break
+            except asyncio.CancelledError:
+                logger.debug("MQTT Dashboard SSE connection closed by client.")
+                break  # Wichtig, um die Schleife zu beenden
+            except Exception as e:
+                logger.error("Error in MQTT Dashboard SSE event_generator: %s", e)
+                await asyncio.sleep(1)  # Kurze Pause vor dem nächsten Versuch
 
 
 # --- SSE ENDPOINT FÜR MQTT DASHBOARD ---
 @app.get("/events/mqtt-updates")
-async def mqtt_dashboard_sse_endpoint(request: Request):
-    """SSE endpoint for MQTT data updates for the dashboard."""
-    return EventSourceResponse(mqtt_dashboard_event_generator(request))
+@app.get("/devices/{device_id}/events/mqtt-updates")
+async def mqtt_dashboard_sse_endpoint(request: Request, mode: str = "full",
+                                      topic_filter: Optional[List[str]] = Query(None, alias="filter"),
+                                      overflow: Optional[str] = None,
+                                      device: mqtt_client.Device = Depends(request_device)):
+    """
+    SSE endpoint for MQTT data updates for the dashboard.
+    mode=delta: nur geänderte Zeilen (htmx out-of-band Swaps) statt der ganzen Tabelle.
+    filter=ext1/# (mehrfach möglich): nur Topics, die auf einen der MQTT-Filter passen.
+    overflow=conflate|drop_oldest|disconnect: Verhalten, wenn der Client nicht nachkommt.
+    """
+    return EventSourceResponse(mqtt_dashboard_event_generator(
+        request, delta=(mode == "delta"), topic_filters=parse_topic_filters(topic_filter),
+        overflow=parse_overflow(overflow), device=device))
 
 # --- SSE ENDPOINT FÜR SETTINGS LIVE-UPDATES ---
 
 
 @app.get("/sse")
-async def settings_sse_stream(request: Request):
+@app.get("/devices/{device_id}/sse")
+async def settings_sse_stream(request: Request, device: mqtt_client.Device = Depends(request_device)):
     """
     Generiert SSE-Events spezifisch für Einstellungs-Updates.
-    Liest von mqtt_client.update_queue.
+    Liest von einem eigenen Abonnement des UpdateHubs des Geräts.
     """
-    # Variablen zur Vermeidung doppelter Verarbeitung durch diesen spezifischen Generator
-    last_update_type_settings = None
-    last_update_topic_settings = None
-    last_update_payload_settings = None
+    cache = settings_caches.cache_for_device(device)
 
     async def event_generator():
-        nonlocal last_update_type_settings, last_update_topic_settings, last_update_payload_settings
-        while True:
-            if await request.is_disconnected():
-                print("Client disconnected from Settings SSE")
-                break
+        with device.update_hub.subscription(stream="settings") as updates:
+            while True:
+                if await request.is_disconnected():
+                    logger.debug("Client disconnected from Settings SSE")
+                    break
 
-            raw_update = None
-            try:
-                # Timeout für Keep-Alive
-                raw_update = await asyncio.wait_for(mqtt_client.update_queue.get(), timeout=30)
-
-                update_type = raw_update.get("type")
-                update_topic = raw_update.get("topic")
-                update_payload = raw_update.get("payload")
-
-                # Verhindere doppelte Verarbeitung derselben Nachricht durch diesen Handler
-                if (update_type == last_update_type_settings and
-                    update_topic == last_update_topic_settings and
-                        update_payload == last_update_payload_settings):
-                    mqtt_client.update_queue.task_done()
-                    raw_update = None
-                    continue
-
-                last_update_type_settings = update_type
-                last_update_topic_settings = update_topic
-                last_update_payload_settings = update_payload
+                try:
+                    # Timeout für Keep-Alive
+                    raw_update = await asyncio.wait_for(updates.get(), timeout=30)
+
+                    # Dieser Handler ist spezifisch für Settings-Updates: nur reagieren,
+                    # wenn das Change-Set geparste 'send_settings' Werte (setting_*) enthält
+                    if raw_update.get("type") == "update" and any(
+                            key.startswith("setting_") for key in raw_update["changes"]):
+                        logger.debug("Settings SSE: 'send_settings' Update erkannt. Rendere Einstellungs-Komponente.")
+                        observe_latency(raw_update, "settings")
+                        yield {"event": "settings_update", "data": render_settings_display(device)}
+                        cache.observe(raw_update)
+                        yield {"event": "settings_status", "data": render_settings_status(device)}
+
+                except asyncio.TimeoutError:
+                    yield {"event": "keep-alive", "data": "settings_keep_alive"}
+                    # z.B. eine Anfrage, auf die der ESP32 nicht geantwortet hat
+                    yield {"event": "settings_status", "data": render_settings_status(device)}
+                except mqtt_client.SubscriptionClosed:
+                    logger.warning("Settings SSE: Client zu langsam, Verbindung wird beendet.")
+                    break
+                except asyncio.CancelledError:
+                    logger.debug("Settings SSE connection closed by client.")
+                    break
+                except Exception as e:
+                    logger.error("Fehler im Settings SSE event_generator: %s", e)
+                    await asyncio.sleep(1)
+    # Die event_generator Funktion ist hier definiert, aber die Route gibt sie zurück
+    return EventSourceResponse(event_generator())
 
-                # Dieser Handler ist spezifisch für Settings-Updates
-                if update_type == "update" and update_topic == "send_settings" and update_payload == "updated":
-                    print(
-                        "Settings SSE: 'send_settings' Update erkannt. Rendere Einstellungs-Komponente.")
-                    with mqtt_client.latest_messages_lock:
-                        current_settings_data = mqtt_client.latest_messages.copy()
+# --- New SSE Generator for Index Page (New Messages) ---
 
-                    html_content = templates.get_template("components/settings_display.html").render({
-                        "request": request,
-                        "settings_data": current_settings_data
-                    })
-                    yield {"event": "settings_update", "data": html_content}
 
-                mqtt_client.update_queue.task_done()
-                raw_update = None
+def is_index_topic(topic: str) -> bool:
+    return not topic.startswith('setting_') and topic != 'send_settings'
 
-            except asyncio.TimeoutError:
-                yield {"event": "keep-alive", "data": "settings_keep_alive"}
-            except asyncio.CancelledError:
-                print("Settings SSE connection closed by client.")
-                break
-            except Exception as e:
-                print(f"Fehler im Settings SSE event_generator: {e}")
-                await asyncio.sleep(1)
-            finally:
-                if raw_update is not None:  # pragma: no cover
-                    try:
-                        mqtt_client.update_queue.task_done()
-                    except ValueError:
-                        pass
-    # Die event_generator Funktion ist hier definiert, aber die Route gibt sie zurück
-    return EventSourceResponse(event_generator())
 
-# --- New SSE Generator for Index Page (New Messages) ---
+def json_patch(update: dict, topic_filters: tuple = None) -> dict:
+    """Change-Set als JSON Merge Patch (RFC 7396): geänderte Keys mit Wert, entfernte mit null."""
+    patch = {k: v for k, v in update["changes"].items() if is_index_topic(k)}
+    patch.update((k, None) for k in update["removed"] if is_index_topic(k))
+    return filter_messages(patch, topic_filters)
 
 
-async def new_message_event_generator(request: Request):
+async def new_message_event_generator(request: Request, topic_filters: tuple = None, overflow: str = None,
+                                      device: mqtt_client.Device = None):
     """
     Generates SSE-Events for new MQTT messages for the index page.
-    Liest von mqtt_client.update_queue.
+    Liest von einem eigenen Abonnement des UpdateHubs des Geräts (ohne Gerät: Standardgerät).
+
+    Jedes Event trägt die Zustandsversion als SSE-id (siehe sse_event_id()). Zuerst wird ein
+    'snapshot' mit allen Nachrichten gesendet, danach nur noch 'patch' Events mit den geänderten Keys.
+    Schickt der Client beim Wiederverbinden Last-Event-ID, werden nur die verpassten
+    Patches aus dem change_log nachgeliefert (oder ein neuer Snapshot, falls zu alt oder
+    aus der Zeit vor einem Neustart).
+    Mit topic_filters (MQTT-Wildcards) enthalten Snapshot und Patches nur passende Topics.
     """
+    device = device or mqtt_client.default_device
     try:
-        while True:
-            update = await mqtt_client.update_queue.get()
-            update_type = update.get('type', '')
-            update_topic = update.get('topic', '')
-            update_payload = update.get('payload', '')
-            
-            if update_type == "update":
-                with mqtt_client.latest_messages_lock:
-                    # Kopiere alle Nachrichten, aber entferne 'send_settings' und 'setting_*'
-                    current_messages = {
-                        k: v for k, v in mqtt_client.latest_messages.items() 
-                        if not k.startswith('setting_') and k != 'send_settings'
-                    }
+        with device.update_hub.subscription(topic_filters, overflow=overflow, stream="new_messages") as updates:
+            missed = None
+            last_event_version = parse_event_id(request.headers.get("last-event-id", ""))
+            if last_event_version is not None:
+                missed = device.changes_since(last_event_version)
+
+            def snapshot_event():
+                version, messages = device.store.snapshot
+                # Alle Nachrichten, aber ohne 'send_settings' und 'setting_*'
+                current_messages = {k: v for k, v in filter_messages(messages, topic_filters).items()
+                                    if is_index_topic(k)}
                 sorted_messages = dict(sorted(current_messages.items()))
-                yield {"data": json.dumps(sorted_messages)}
-            
-            mqtt_client.update_queue.task_done()
-            
-            if await request.is_disconnected():
-                break
-                
+                return version, {"event": "snapshot", "id": sse_event_id(version), "data": json.dumps(sorted_messages)}
+
+            if missed is None:
+                last_sent_version, event = snapshot_event()
+                yield event
+            else:
+                last_sent_version = last_event_version
+                for update in missed:
+                    last_sent_version = update["version"]
+                    patch = json_patch(update, topic_filters)
+                    if patch:
+                        yield {"event": "patch", "id": sse_event_id(last_sent_version), "data": json.dumps(patch)}
+
+            while True:
+                update = await updates.get()
+
+                if updates.needs_resync():
+                    # Updates verworfen (drop_oldest): Patches allein wären unvollständig
+                    last_sent_version, event = snapshot_event()
+                    yield event
+                # Bereits im Snapshot bzw. in den nachgelieferten Patches enthalten
+                elif update.get('type') == "update" and update["version"] > last_sent_version:
+                    last_sent_version = update["version"]
+                    patch = json_patch(update)
+                    if patch:
+                        observe_latency(update, "new_messages")
+                        yield {"event": "patch", "id": sse_event_id(last_sent_version), "data": json.dumps(patch)}
+
+                if await request.is_disconnected():
+                    break
+
+    except mqtt_client.SubscriptionClosed:
+        logger.warning("New Messages SSE: Client zu langsam, Verbindung wird beendet.")
     except asyncio.CancelledError:
-        print("New Messages SSE connection closed by client.")
+        logger.debug("New Messages SSE connection closed by client.")
     except Exception as e:
-        print(f"Error in New Messages SSE event_generator: {e}")
+        logger.error("Error in New Messages SSE event_generator: %s", e)
+
+
+# --- ZEITREIHEN (HISTORY) ---
+
+
+@app.get("/history/{topic:path}")
+@app.get("/devices/{device_id}/history/{topic:path}")
+async def get_history(topic: str, start: Optional[float] = Query(None, alias="from"),
+                      end: Optional[float] = Query(None, alias="to"),
+                      device: mqtt_client.Device = Depends(request_device)):
+    """Gibt die gespeicherten Messwerte eines Topics im Zeitraum [from, to] (Unix-Sekunden) zurück."""
+    buffer = device.history.get(topic)
+    if buffer is None:
+        raise HTTPException(status_code=404, detail=f"Keine Zeitreihe für Topic '{topic}'")
+    timestamps, values = buffer.range(start, end)
+    return {"topic": topic, "points": [[t, v] for t, v in zip(timestamps, values)]}
+
+
+class ChartCache:
+    """
+    LRU-Cache für aggregierte Chart-Daten. Der Key enthält den Datenstand des Zeitfensters
+    (siehe chart_window_version()), geänderte Daten machen die Einträge also automatisch ungültig.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Das gespeicherte Ergebnis oder None."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        return None
+
+    def put(self, key, result):
+        self._entries[key] = result
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return result
+
+
+chart_cache = ChartCache()
+
+
+def chart_window_version(buffer: history.RingBuffer, start: Optional[float], end: Optional[float]):
+    """
+    Datenstand des Zeitfensters [start, end] für den Cache-Key. Neue Werte ändern nur offene oder
+    bis in die Gegenwart reichende Fenster; verdrängte alte Werte nur Fenster, die vor dem
+    ältesten Eintrag beginnen. Abgeschlossene Fenster in der Vergangenheit bleiben so gültig.
+    """
+    newest, oldest = buffer.newest, buffer.oldest
+    appended = buffer.appended if end is None or newest is None or end >= newest else None
+    evicted = oldest if start is None or oldest is None or start <= oldest else None
+    return appended, evicted
+
+
+@app.get("/chart/{topic:path}")
+@app.get("/devices/{device_id}/chart/{topic:path}")
+async def get_chart(topic: str, start: Optional[float] = Query(None, alias="from"),
+                    end: Optional[float] = Query(None, alias="to"),
+                    max_points: int = Query(300, ge=3, le=5000), mode: str = "minmax",
+                    device: mqtt_client.Device = Depends(request_device)):
+    """
+    Gibt die Zeitreihe eines Topics auf höchstens max_points verdichtet zurück:
+    mode=minmax: min/max/mean pro Zeitfenster, mode=lttb: LTTB-Downsampling.
+    Die Daten werden im Event Loop kopiert und im Threadpool verdichtet.
+    """
+    buffer = device.history.get(topic)
+    if buffer is None:
+        raise HTTPException(status_code=404, detail=f"Keine Zeitreihe für Topic '{topic}'")
+    if mode not in ("minmax", "lttb"):
+        raise HTTPException(status_code=400, detail=f"Unbekannter Modus '{mode}'")
+
+    key = (device.id, topic, start, end, max_points, mode, chart_window_version(buffer, start, end))
+    result = chart_cache.get(key)
+    if result is not None:
+        return result
+
+    def compute(timestamps, values):
+        if not timestamps:
+            return {"topic": topic, "mode": mode, "points": []}
+        if mode == "lttb":
+            ts, vs = history.lttb(timestamps, values, max_points)
+            return {"topic": topic, "mode": mode, "points": np.column_stack((ts, vs)).tolist()}
+        bucket_start, minimum, maximum, mean = history.aggregate_buckets(
+            timestamps, values,
+            timestamps[0] if start is None else start,
+            timestamps[-1] if end is None else end,
+            max_points)
+        return {"topic": topic, "mode": mode,
+                "points": np.column_stack((bucket_start, minimum, maximum, mean)).tolist()}
+
+    timestamps, values = buffer.range(start, end)
+    return chart_cache.put(key, await run_in_threadpool(compute, timestamps, values))
 
 
 # --- New Endpoint to return the latest message HTML fragment ---
@@ -350,9 +867,31 @@ async def get_latest_message_html():
 
 
 @app.get("/events/new-messages")
-async def new_messages_sse_endpoint(request: Request):
-    """SSE endpoint for new MQTT message updates for the index page."""
-    return EventSourceResponse(new_message_event_generator(request))
+@app.get("/devices/{device_id}/events/new-messages")
+async def new_messages_sse_endpoint(request: Request,
+                                    topic_filter: Optional[List[str]] = Query(None, alias="filter"),
+                                    overflow: Optional[str] = None,
+                                    device: mqtt_client.Device = Depends(request_device)):
+    """
+    SSE endpoint for new MQTT message updates for the index page.
+    filter=ext1/# (mehrfach möglich): nur Topics, die auf einen der MQTT-Filter passen.
+    overflow=conflate|drop_oldest|disconnect: Verhalten, wenn der Client nicht nachkommt.
+    """
+    return EventSourceResponse(new_message_event_generator(
+        request, parse_topic_filters(topic_filter), parse_overflow(overflow), device))
+
+
+# --- GERÄTE ---
+
+
+@app.get("/devices")
+async def list_devices():
+    """Alle bekannten Geräte mit Zustandsversion, Anzahl Keys und letzter Statusmeldung."""
+    return {"devices": [
+        {"id": device.id, "version": device.store.version, "keys": len(device.store.messages),
+         "status": device.store.messages.get("status"), "url_prefix": device_url_prefix(device)}
+        for device in list(mqtt_client.devices.values())
+    ]}
 
 # Statische Dateien (CSS, JS, Bilder etc.)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+
+# Alle registrierten Metriken, in Reihenfolge der Definition
+REGISTRY = []
+
+# Standard-Buckets für Latenzen (Sekunden)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric:
+    """
+    Basis für Metriken mit Aggregation pro Thread: jeder schreibende Thread hat eine eigene
+    Zelle (dict), in die nur er schreibt; es gibt also keine Locks auf dem Hot Path.
+    Beim Auslesen (/metrics) werden die Zellen aller Threads summiert.
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._cells = []
+        self._cells_lock = threading.Lock()  # nur beim ersten Zugriff eines Threads
+        REGISTRY.append(self)
+
+    def _cell(self) -> dict:
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = self._local.cell = {}
+            with self._cells_lock:
+                self._cells.append(cell)
+        return cell
+
+    def _snapshot(self):
+        """Summe aller Thread-Zellen: labelvalues -> Wert."""
+        total = {}
+        with self._cells_lock:
+            cells = list(self._cells)
+        for cell in cells:
+            # dict(cell) kopiert atomar (GIL), auch wenn der Besitzer-Thread gerade schreibt
+            for key, value in dict(cell).items():
+                total[key] = self._merge(total.get(key), value)
+        return total
+
+    def _merge(self, current, value):
+        return value if current is None else current + value
+
+    def _labels(self, labelvalues, extra=()) -> str:
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for labelvalues, value in sorted(self._snapshot().items()):
+            yield f"{self.name}{self._labels(labelvalues)} {_format(value)}"
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount: float = 1):
+        cell = self._cell()
+        cell[labelvalues] = cell.get(labelvalues, 0) + amount
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labelvalues):
+        cell = self._cell()
+        counts = cell.get(labelvalues)
+        if counts is None:
+            # [Zähler pro Bucket..., +Inf, Summe]
+            counts = cell[labelvalues] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-1] += value
+
+    def _merge(self, current, value):
+        value = list(value)
+        return value if current is None else [a + b for a, b in zip(current, value)]
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for labelvalues, counts in sorted(self._snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format(bound)
+                yield f"{self.name}_bucket{self._labels(labelvalues, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{self._labels(labelvalues)} {_format(counts[-1])}"
+            yield f"{self.name}_count{self._labels(labelvalues)} {cumulative}"
+
+
+class Gauge(_Metric):
+    """Momentanwert, der erst beim Auslesen über `collect()` ermittelt wird: labelvalues -> Wert."""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+        self._value = {}
+
+    def set(self, value: float, *labelvalues):
+        self._value[labelvalues] = value
+
+    def _snapshot(self):
+        if self.collect is not None:
+            return self.collect()
+        return dict(self._value)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render() -> str:
+    """Alle Metriken im Prometheus-Textformat."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Metriken ---
+
+mqtt_messages_received = Counter(
+    "mqtt_messages_received_total", "Empfangene MQTT-Nachrichten pro Topic.", ["topic"])
+mqtt_decode_errors = Counter(
+    "mqtt_decode_errors_total", "MQTT-Nachrichten mit ungültigem UTF-8 im Payload pro Topic.", ["topic"])
+mqtt_ingest_flushes = Counter(
+    "mqtt_ingest_flushes_total", "Ingest-Flushes (zusammengefasste Change-Sets).")
+ingest_to_sse_latency = Histogram(
+    "mqtt_ingest_to_sse_seconds", "Zeit vom Empfang einer MQTT-Nachricht bis zum Senden per SSE.", ["stream"])
+template_render_seconds = Histogram(
+    "template_render_seconds", "Renderzeit der Jinja-Templates (nur Cache-Misses).", ["template"])
+mqtt_reconnects = Counter(
+    "mqtt_reconnects_total", "Erfolgreiche Wiederverbindungen zum MQTT Broker.")
+publish_roundtrip_seconds = Histogram(
+    "mqtt_publish_roundtrip_seconds", "Zeit von publish() bis zur Bestätigung durch paho (on_publish).")
+sse_dropped_updates = Counter(
+    "sse_dropped_updates_total", "Wegen Überlauf verworfene SSE-Updates.", ["stream"])
+sse_conflated_updates = Counter(
+    "sse_conflated_updates_total", "Wegen Überlauf zusammengefasste SSE-Updates.", ["stream"])
+sse_uncompressed_bytes = Counter(
+    "sse_uncompressed_bytes_total", "SSE-Daten vor der Kompression pro Content-Encoding.", ["encoding"])
+sse_compressed_bytes = Counter(
+    "sse_compressed_bytes_total", "Tatsächlich gesendete (komprimierte) SSE-Daten pro Content-Encoding.", ["encoding"])
+event_loop_lag_seconds = Histogram(
+    "event_loop_lag_seconds", "Verzögerung des asyncio Event Loops gegenüber dem geplanten Zeitpunkt.")
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Misst periodisch, wie viel später als geplant der Event Loop eine Pause beendet."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, loop.time() - started - interval))
@@ -1,15 +1,36 @@
 import paho.mqtt.client as mqtt
-import threading
 import time
-import json  # Hinzugefügt für JSON Parsing
 import asyncio  # Hinzugefügt
-
-# MQTT Broker Konfiguration
-MQTT_BROKER_HOST = "81.7.10.99"
-MQTT_BROKER_PORT = 1883
-MQTT_USERNAME = "klaus"
+import collections
+import contextlib
+import logging
+import os
+import random
+from types import MappingProxyType
+
+from app import decoders, metrics
+from app.history import RingBuffer
+from app.outbox import Outbox
+from app.persistence import MessageLog
+from app.topics import TopicTrie, is_valid_topic
+
+logger = logging.getLogger(__name__)
+
+# MQTT Broker Konfiguration (per Umgebungsvariable überschreibbar, z.B. für Benchmarks)
+MQTT_BROKER_HOST = os.environ.get("MQTT_BROKER_HOST", "81.7.10.99")
+MQTT_BROKER_PORT = int(os.environ.get("MQTT_BROKER_PORT", 1883))
+MQTT_USERNAME = os.environ.get("MQTT_USERNAME", "klaus")
 # ACHTUNG: Passwort sollte idealerweise nicht hartcodiert sein!
-MQTT_PASSWORD = "DHisddS!"
+MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD", "DHisddS!")
+# "thread": paho-Netzwerk-Loop in einem eigenen Thread (loop_start)
+# "asyncio": der Socket wird direkt im Event Loop von uvicorn bedient (kein Thread-Wechsel pro Nachricht)
+MQTT_TRANSPORT = os.environ.get("MQTT_TRANSPORT", "thread")
+# Wartezeit vor einem neuen Verbindungsversuch: verdoppelt sich pro Fehlversuch bis zum Maximum,
+# davon wird zufällig zwischen der Hälfte und dem vollen Wert gewartet (Jitter, Sekunden)
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+# Maximale Wartezeit auf das CONNACK des Brokers beim Start (Sekunden)
+CONNECT_TIMEOUT = float(os.environ.get("MQTT_CONNECT_TIMEOUT", 10))
 
 MQTT_TOPICS = [
     "esp32/zisterne",
@@ -29,64 +50,16 @@ MQTT_TOPICS = [
     "test"
 ]
 
-# Globaler Speicher für die letzten Nachrichten und asyncio Queue
-latest_messages = {}
-
-# Lock für Thread-sichere Updates
-latest_messages_lock = asyncio.Lock()
-
-# Event für neue Nachrichten
-new_message_event = asyncio.Event()
-
-# Update Queue für neue Nachrichten
-update_queue = asyncio.Queue()
-
-# MQTT Client Instanz
-client = mqtt.Client()
-
-# Verbindung zum Broker herstellen
-client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-
-# Callback für neue Nachrichten
-def on_message(client, userdata, msg):
-    """Wird aufgerufen, wenn eine neue MQTT-Nachricht empfangen wird."""
-    try:
-        topic = msg.topic
-        payload = msg.payload.decode()
-        
-        # Speichere die Nachricht
-        with latest_messages_lock:
-            latest_messages[topic] = payload
-            
-        # Signalisiere neue Nachricht
-        new_message_event.set()
-        
-        # Leere die Queue
-        while not update_queue.empty():
-            update_queue.get_nowait()
-            update_queue.task_done()
-            
-        # Füge neue Nachricht zur Queue hinzu
-        update_queue.put_nowait({"type": "update", "topic": topic, "payload": payload})
-        
-        print(f"MQTT_CLIENT: Nachricht empfangen auf Topic '{topic}': {payload}")
-        
-    except Exception as e:
-        print(f"MQTT_CLIENT: Fehler beim Verarbeiten der Nachricht: {e}")
-
-# MQTT Client initialisieren
-client.on_message = on_message
-
 async def connect():
     """Verbindung zum MQTT Broker herstellen."""
     try:
         client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
         client.subscribe([(topic, 0) for topic in MQTT_TOPICS])
         client.loop_start()
-        print("MQTT_CLIENT: Verbunden mit MQTT Broker")
+        logger.info("Verbunden mit MQTT Broker")
         return True
     except Exception as e:
-        print(f"MQTT_CLIENT: Verbindung fehlgeschlagen: {e}")
+        logger.error("Verbindung fehlgeschlagen: %s", e)
         return False
 
 async def disconnect():
@@ -94,334 +67,930 @@ async def disconnect():
     try:
         client.loop_stop()
         client.disconnect()
-        print("MQTT_CLIENT: Verbindung getrennt")
+        logger.info("Verbindung getrennt")
         return True
     except Exception as e:
-        print(f"MQTT_CLIENT: Fehler beim Trennen der Verbindung: {e}")
+        logger.error("Fehler beim Trennen der Verbindung: %s", e)
         return False
 
-async def send_message(topic: str, message: str):
-    """Sendet eine MQTT-Nachricht."""
+async def send_message(topic: str, message: str, qos=0, retain=False, timeout=None):
+    """
+    Sendet eine MQTT-Nachricht, ohne den Event Loop zu blockieren, und wartet auf die
+    Bestätigung durch paho (on_publish). Gibt True bei Erfolg, sonst False zurück.
+    """
+    return await send_message_status(topic, message, qos, retain, timeout) == "delivered"
+
+
+async def send_message_status(topic: str, message: str, qos=0, retain=False, timeout=None) -> str:
+    """
+    Wie send_message, liefert aber den Zustellstatus: "delivered" (von paho bestätigt),
+    "queued" (offline angenommen, wird nach dem Wiederverbinden gesendet) oder "failed".
+    Ungültige Topics ergeben einen ValueError (siehe publish_message_async).
+    """
+    _check_topic(topic)
+    if remote_publisher is not None:
+        # Der Ingest-Prozess sendet, wertet Outbox und Timeout aus und meldet den Status zurück
+        return await remote_publisher(topic, message, qos, retain, status=True, timeout=timeout)
+    future = publish_message_async(topic, message, qos, retain)
+    # Gepufferte Nachrichten werden erst nach dem Wiederverbinden an paho übergeben;
+    # nur auf die Bestätigung von tatsächlich gesendeten Nachrichten warten
+    if outbox.is_queued(future):
+        return "queued"
     try:
-        client.publish(topic, message)
-        print(f"MQTT_CLIENT: Nachricht gesendet auf Topic '{topic}': {message}")
-        return True
-    except Exception as e:
-        print(f"MQTT_CLIENT: Fehler beim Senden der Nachricht: {e}")
-        return False
+        delivered = await asyncio.wait_for(future, timeout or PUBLISH_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Timeout beim Senden der Nachricht auf Topic '%s'", topic, extra={"topic": topic})
+        return "failed"
+    return "delivered" if delivered else "failed"
+
+# Maximale Anzahl gleichzeitig unbestätigter Publishes bei Sammelaufträgen
+BULK_PUBLISH_WINDOW = 32
+
+
+async def send_messages(items, window=BULK_PUBLISH_WINDOW, timeout=None):
+    """
+    Sendet mehrere Nachrichten (topic, payload, qos, retain) in Reihenfolge, mit höchstens
+    `window` unbestätigten Publishes gleichzeitig. Gibt die Ergebnisse (True/False) in
+    derselben Reihenfolge wie `items` zurück.
+    """
+    return [status == "delivered" for status in await send_messages_status(items, window, timeout)]
+
+
+async def send_messages_status(items, window=BULK_PUBLISH_WINDOW, timeout=None):
+    """Wie send_messages, aber mit dem Zustellstatus pro Nachricht (siehe send_message_status)."""
+    semaphore = asyncio.Semaphore(window)
+
+    async def send_one(topic, payload, qos, retain):
+        async with semaphore:
+            # Ein fehlerhafter Eintrag darf die übrigen nicht abbrechen
+            try:
+                return await send_message_status(topic, payload, qos, retain, timeout)
+            except ValueError as e:
+                logger.error("Nachricht an Topic '%s' abgelehnt: %s", topic, e, extra={"topic": topic})
+                return "failed"
+
+    return await asyncio.gather(*(send_one(*item) for item in items))
 
 async def is_connected():
     """Gibt den Verbindungsstatus zurück."""
     return client.is_connected()
-latest_messages_lock = threading.Lock()  # Lock für latest_messages
-update_queue = asyncio.Queue()
 app_event_loop = None  # Wird von main.py gesetzt
 
+
+_MISSING = object()
+
+
+class StateStore:
+    """
+    Versionierte, unveränderliche Snapshots der letzten MQTT-Nachrichten.
+    Es gibt genau einen Schreiber (den Ingest-Flush im Event Loop): commit() baut eine neue
+    Mapping-Instanz und ersetzt die Referenz atomar. Leser holen sich den
+    aktuellen Snapshot ohne Lock und ohne Kopie.
+    """
+
+    def __init__(self):
+        self._snapshot = (0, MappingProxyType({}))
+        # Version, in der sich ein Key zuletzt geändert hat (auch entfernte Keys, für ETags)
+        self._key_versions = {}
+
+    @property
+    def snapshot(self):
+        """(Version, schreibgeschütztes Mapping) – immer zueinander passend."""
+        return self._snapshot
+
+    @property
+    def version(self) -> int:
+        return self._snapshot[0]
+
+    @property
+    def messages(self):
+        return self._snapshot[1]
+
+    @property
+    def key_versions(self):
+        return self._key_versions
+
+    def key_version(self, key: str) -> int:
+        """Version, in der sich `key` zuletzt geändert hat (0 = noch nie gesehen)."""
+        return self._key_versions.get(key, 0)
+
+    def commit(self, changes: dict, removed=(), version: int = None):
+        """
+        Übernimmt Änderungen als neue Version (nur vom Schreiber-Thread aufrufen).
+        `version` wird nur von Replikaten gesetzt, die die Versionen des Ingest-Prozesses übernehmen.
+        """
+        current_version, current = self._snapshot
+        if version is None:
+            version = current_version + 1
+        data = dict(current)
+        for key, value in changes.items():
+            # Unveränderte Werte (z.B. wiederholte Statusmeldungen) behalten ihre Version
+            if key not in data or data[key] != value:
+                self._key_versions[key] = version
+        data.update(changes)
+        for key in removed:
+            if data.pop(key, _MISSING) is not _MISSING:
+                self._key_versions[key] = version
+        self._snapshot = (version, MappingProxyType(data))
+        return version
+
+    def restore(self, version: int, data: dict):
+        """Setzt einen gespeicherten Zustand (z.B. beim Start aus dem MessageLog)."""
+        self._snapshot = (version, MappingProxyType(dict(data)))
+        # Wann sich die Keys zuletzt geändert haben, ist unbekannt: konservativ die aktuelle Version
+        self._key_versions = dict.fromkeys(data, version)
+
+
+# Maximale Anzahl wartender Updates pro SSE-Verbindung und Verhalten bei Überlauf:
+# "conflate" (wartende Updates zusammenfassen, nur der letzte Wert pro Key bleibt),
+# "drop_oldest" (ältestes Update verwerfen) oder "disconnect" (Verbindung beenden)
+SUBSCRIBER_QUEUE_SIZE = 100
+SUBSCRIBER_OVERFLOW = "conflate"
+OVERFLOW_POLICIES = ("conflate", "drop_oldest", "disconnect")
+
+
+class SubscriptionClosed(Exception):
+    """Das Abonnement wurde wegen Überlaufs (Policy "disconnect") beendet."""
+
+
+def merge_updates(older: dict, newer: dict) -> dict:
+    """Fasst zwei aufeinanderfolgende Change-Sets zu einem zusammen (neuester Wert pro Key)."""
+    changes = {k: v for k, v in older["changes"].items() if k not in newer["removed"]}
+    changes.update(newer["changes"])
+    removed = {k: None for k in older["removed"] if k not in newer["changes"]}
+    removed.update(dict.fromkeys(newer["removed"]))
+    return dict(newer,
+                topics=list(dict.fromkeys(older["topics"] + newer["topics"])),
+                topic_received_at=dict(older.get("topic_received_at", {}), **newer.get("topic_received_at", {})),
+                changes=changes,
+                removed=tuple(removed),
+                received_at=older.get("received_at"))
+
+
+class Subscription:
+    """
+    Begrenzte Queue einer SSE-Verbindung. Ist sie voll, entscheidet die Overflow-Policy,
+    was mit neuen Updates passiert; dropped/conflated zählen die betroffenen Updates.
+    Der Speicher pro Client bleibt so unabhängig davon begrenzt, wie langsam er liest.
+    Nach verworfenen Updates (drop_oldest) meldet needs_resync() einmalig True; der Leser
+    muss dann den kompletten Zustand senden, da die Change-Sets allein unvollständig sind.
+    """
+
+    def __init__(self, maxsize: int = None, overflow: str = None, stream: str = "default"):
+        self.stream = stream
+        self.maxsize = maxsize or SUBSCRIBER_QUEUE_SIZE
+        self.overflow = overflow or SUBSCRIBER_OVERFLOW
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unbekannte Overflow-Policy: '{self.overflow}'")
+        self.dropped = 0
+        self.conflated = 0
+        self.closed = False
+        self._lost = False
+        self._items = collections.deque()
+        self._ready = asyncio.Event()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def put_nowait(self, update: dict):
+        if self.closed:
+            return
+        if len(self._items) < self.maxsize:
+            self._items.append(update)
+        elif self.overflow == "conflate":
+            self._items[-1] = merge_updates(self._items[-1], update)
+            self.conflated += 1
+            metrics.sse_conflated_updates.inc(self.stream)
+        elif self.overflow == "drop_oldest":
+            self._items.popleft()
+            self._items.append(update)
+            self.dropped += 1
+            self._lost = True
+            metrics.sse_dropped_updates.inc(self.stream)
+        else:
+            self.dropped += len(self._items) + 1
+            metrics.sse_dropped_updates.inc(self.stream, amount=len(self._items) + 1)
+            self._items.clear()
+            self.closed = True
+        self._ready.set()
+
+    def needs_resync(self) -> bool:
+        """True, wenn seit dem letzten Aufruf Updates verworfen wurden."""
+        lost, self._lost = self._lost, False
+        return lost
+
+    async def get(self) -> dict:
+        while not self._items:
+            if self.closed:
+                raise SubscriptionClosed()
+            self._ready.clear()
+            await self._ready.wait()
+        return self._items.popleft()
+
+
+class UpdateHub:
+    """
+    Verteilt Updates an alle verbundenen SSE-Clients (Publish/Subscribe).
+    Jede SSE-Verbindung bekommt eine eigene, begrenzte Queue (Subscription); ein Update wird einmal
+    veröffentlicht und als dasselbe (unveränderte) Objekt an alle Queues verteilt.
+    Abonnements mit Topic-Filtern (MQTT-Wildcards '+'/'#') werden über einen
+    TopicTrie geroutet und erhalten nur die passenden Keys des Change-Sets.
+    Alle Methoden laufen im asyncio Event Loop.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._filtered = {}  # Subscription -> Topic-Filter
+        self._trie = TopicTrie()
+
+    def __len__(self):
+        return len(self._subscribers) + len(self._filtered)
+
+    def __iter__(self):
+        yield from self._subscribers
+        yield from self._filtered
+
+    def subscribe(self, topic_filters=None, maxsize: int = None, overflow: str = None,
+                  stream: str = "default") -> Subscription:
+        queue = Subscription(maxsize, overflow, stream)
+        if topic_filters:
+            topic_filters = tuple(dict.fromkeys(topic_filters))
+            for topic_filter in topic_filters:
+                self._trie.insert(topic_filter, queue)
+            self._filtered[queue] = topic_filters
+        else:
+            self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: Subscription):
+        self._subscribers.discard(queue)
+        for topic_filter in self._filtered.pop(queue, ()):
+            self._trie.remove(topic_filter, queue)
+        if queue.dropped or queue.conflated:
+            logger.info("UpdateHub: Langsamer Client - %d Updates verworfen, %d zusammengefasst (%s)",
+                        queue.dropped, queue.conflated, queue.overflow, extra={"stream": queue.stream})
+
+    @contextlib.contextmanager
+    def subscription(self, topic_filters=None, maxsize: int = None, overflow: str = None,
+                     stream: str = "default"):
+        """Abonnement für die Dauer einer SSE-Verbindung (optional nur für passende Topics)."""
+        queue = self.subscribe(topic_filters, maxsize, overflow, stream)
+        try:
+            yield queue
+        finally:
+            self.unsubscribe(queue)
+
+    def publish(self, update: dict):
+        for queue in self._subscribers:
+            queue.put_nowait(update)
+        if not self._filtered:
+            return
+
+        # Pro Key einmal durch den Trie; jede Queue sammelt die für sie passenden Keys
+        matched = {}
+        for key, value in update["changes"].items():
+            for queue in self._trie.match(key):
+                matched.setdefault(queue, ({}, {}))[0][key] = value
+        for key in update["removed"]:
+            for queue in self._trie.match(key):
+                matched.setdefault(queue, ({}, {}))[1][key] = None
+        for queue, (changes, removed) in matched.items():
+            queue.put_nowait(dict(update, changes=changes, removed=tuple(removed)))
+
+
+# Ingest-Puffer zwischen paho-Thread und Event Loop: Nachrichten werden gesammelt und
+# höchstens einmal pro Zeitfenster gemeinsam übernommen (0 = einmal pro Loop-Durchlauf)
+INGEST_FLUSH_WINDOW = 0.02  # Sekunden
+_ingest_buffer = collections.deque()
+_flush_scheduled = False
+
+# Kapazität der Zeitreihen (RingBuffer) pro Key
+HISTORY_CAPACITY = 10000
+
+# Die letzten Change-Sets pro Gerät für wiederaufnehmbare Streams (Last-Event-ID)
+CHANGE_LOG_SIZE = 1000
+
+# MQTT-Topics '<Präfix><Geräte-ID>/<Topic>' gehören zum Gerät mit dieser ID (None = nur ein Gerät).
+# Alle anderen Topics gehören zum Standardgerät, der bisherigen Einzelgeräte-Installation.
+DEVICE_TOPIC_PREFIX = os.environ.get("MQTT_DEVICE_PREFIX", "devices/")
+DEFAULT_DEVICE = "default"
+
+# Kennung dieses Zustands-Ursprungs, neu bei jedem Prozessstart: Versionen beginnen ohne Datenbank
+# wieder bei 0 und sind daher nur zusammen mit boot_id eindeutig (ETags, SSE-ids). Cluster-Worker
+# übernehmen die Kennung des Ingest-Prozesses mit dessen Snapshot.
+boot_id = os.urandom(6).hex()
+
+# Dauerhaftes Log aller Change-Sets aller Geräte (schreibt in einem eigenen Thread)
+message_log = MessageLog()
+
+
+class Device:
+    """
+    Shard des Zustands für ein Gerät: eigener StateStore (eigene Versionen), UpdateHub,
+    change_log und eigene Zeitreihen. Ein Update eines Geräts kopiert nur dessen Zustand und
+    erreicht nur dessen Abonnenten; der Aufwand pro Nachricht hängt nicht von der Anzahl der
+    Geräte ab. Keys sind die Topics ohne Geräte-Präfix (z.B. 'status', 'setting_timer_h_1').
+    """
+
+    def __init__(self, device_id: str, topic_prefix: str = ""):
+        self.id = device_id
+        self.topic_prefix = topic_prefix
+        self.store = StateStore()
+        self.update_hub = UpdateHub()
+        self.change_log = collections.deque(maxlen=CHANGE_LOG_SIZE)
+        # Zeitreihen der numerischen Werte: Key -> RingBuffer (feste Kapazität pro Key)
+        self.history = {}
+
+    def topic(self, local_topic: str) -> str:
+        """MQTT-Topic für Nachrichten an dieses Gerät (z.B. 'settings' -> 'devices/abc/settings')."""
+        return self.topic_prefix + local_topic
+
+    def append_history(self, key: str, received_at: float, value: float):
+        buffer = self.history.get(key)
+        if buffer is None:
+            buffer = self.history[key] = RingBuffer(HISTORY_CAPACITY)
+        buffer.append(received_at, value)
+
+    def commit(self, update: dict):
+        """
+        Übernimmt ein Update (mit oder ohne Version) und verteilt es an die Abonnenten des
+        Geräts sowie an device_updates (dort mit der Geräte-ID unter "device").
+        """
+        update["version"] = self.store.commit(update["changes"], update["removed"], version=update.get("version"))
+        update["device"] = self.id
+        self.change_log.append(update)
+        self.update_hub.publish(update)
+        device_updates.publish(update)
+        return update
+
+    def changes_since(self, version: int):
+        """
+        Gibt alle Change-Sets mit einer Version > `version` zurück (ältestes zuerst) oder None,
+        wenn diese nicht mehr lückenlos im change_log liegen (oder die Version unbekannt ist).
+        """
+        current = self.store.version
+        if version > current:
+            return None
+        if version == current:
+            return []
+        if not self.change_log or self.change_log[0]["version"] > version + 1:
+            return None
+        return [update for update in self.change_log if update["version"] > version]
+
+
+# Standardgerät: alle Topics ohne Geräte-Präfix
+default_device = Device(DEFAULT_DEVICE)
+
+# Geräte-ID -> Device; neue Geräte entstehen mit ihrer ersten Nachricht (im Event Loop)
+devices = {DEFAULT_DEVICE: default_device}
+# Updates aller Geräte, auch später angelegter (z.B. für die Replikation im Cluster-Modus)
+device_updates = UpdateHub()
+
+
+def split_device_topic(topic: str):
+    """'devices/abc/status' -> ('abc', 'status'); Topics ohne Geräte-Präfix gehören zum Standardgerät."""
+    if DEVICE_TOPIC_PREFIX and topic.startswith(DEVICE_TOPIC_PREFIX):
+        device_id, _, local_topic = topic[len(DEVICE_TOPIC_PREFIX):].partition("/")
+        if device_id and local_topic:
+            return device_id, local_topic
+    return DEFAULT_DEVICE, topic
+
+
+def get_device(device_id: str) -> Device:
+    """Das Gerät mit dieser ID, bei Bedarf neu angelegt (nur im Event Loop aufrufen)."""
+    device = devices.get(device_id)
+    if device is None:
+        device = devices[device_id] = Device(device_id, f"{DEVICE_TOPIC_PREFIX}{device_id}/")
+        logger.info("Neues Gerät '%s'", device_id)
+    return device
+
+# Nur im Ingest-Prozess des Cluster-Modus: Updates tragen zusätzlich die einzelnen Messwerte
+# ("samples"), damit die Worker ihre Zeitreihen ebenfalls füllen können
+collect_samples = False
+
+
+def _collect_subscriptions(value):
+    # Läuft beim Auslesen von /metrics im Event Loop, wie alle Zugriffe auf den UpdateHub
+    result = {}
+    for hub in [device_updates] + [device.update_hub for device in list(devices.values())]:
+        for queue in hub:
+            key = (queue.stream,)
+            result[key] = value(result.get(key, 0), queue)
+    return result
+
+
+metrics.Gauge("mqtt_ingest_buffer_depth", "Nachrichten im Ingest-Puffer, die noch nicht übernommen wurden.",
+              collect=lambda: {(): len(_ingest_buffer)})
+metrics.Gauge("sse_subscribers", "Verbundene SSE-Clients pro Stream.", ["stream"],
+              collect=lambda: _collect_subscriptions(lambda total, queue: total + 1))
+metrics.Gauge("sse_queue_depth", "Wartende Updates in den SSE-Queues pro Stream (Summe).", ["stream"],
+              collect=lambda: _collect_subscriptions(lambda total, queue: total + queue.qsize()))
+metrics.Gauge("sse_queue_depth_max", "Längste SSE-Queue pro Stream.", ["stream"],
+              collect=lambda: _collect_subscriptions(lambda longest, queue: max(longest, queue.qsize())))
+metrics.Gauge("mqtt_devices", "Bekannte Geräte (Shards), inklusive Standardgerät.",
+              collect=lambda: {(): len(devices)})
+
+
+def _schedule_flush():
+    if INGEST_FLUSH_WINDOW > 0:
+        app_event_loop.call_later(INGEST_FLUSH_WINDOW, _flush_ingest)
+    else:
+        _flush_ingest()
+
+
+class _IngestBatch:
+    """Die in einem Flush gesammelten Nachrichten eines Geräts."""
+
+    def __init__(self, with_samples: bool):
+        self.topics = {}  # Topic -> Empfangszeit der letzten Nachricht (geordnet, ohne Duplikate)
+        self.changes = {}
+        self.removed = set()
+        self.samples = [] if with_samples else None
+        self.received_at = None
+
+    def add(self, device: Device, topic, changes, removed, numeric, received_at):
+        self.topics[topic] = received_at
+        if self.received_at is None:
+            self.received_at = received_at
+        # Zeitreihen bekommen jeden einzelnen Messwert, nicht nur den letzten des Batches
+        for key, value in numeric.items():
+            device.append_history(key, received_at, value)
+            if self.samples is not None:
+                self.samples.append((key, received_at, value))
+        for key in removed:
+            self.changes.pop(key, None)
+            self.removed.add(key)
+        self.changes.update(changes)
+        self.removed.difference_update(changes)
+
+
+def _flush_ingest():
+    """
+    Übernimmt alle gepufferten Nachrichten pro Gerät als eine neue Snapshot-Version und
+    veröffentlicht je Gerät ein zusammengefasstes Update (Change-Set) an dessen UpdateHub.
+    Geräte ohne neue Nachrichten bleiben unberührt.
+    """
+    global _flush_scheduled
+    # Vor dem Leeren zurücksetzen: spätere Nachrichten planen einen neuen Flush
+    _flush_scheduled = False
+
+    batches = {}  # Device -> _IngestBatch
+    while _ingest_buffer:
+        device_id, topic, changes, removed, numeric, received_at = _ingest_buffer.popleft()
+        device = get_device(device_id)
+        batch = batches.get(device)
+        if batch is None:
+            batch = batches[device] = _IngestBatch(collect_samples)
+        batch.add(device, topic, changes, removed, numeric, received_at)
+
+    for device, batch in batches.items():
+        update = {
+            "type": "update",
+            "version": None,  # vergibt Device.commit()
+            "topics": list(batch.topics),
+            # Empfangszeit pro Topic (z.B. zur Zuordnung der Antwort auf REQUEST_SETTINGS)
+            "topic_received_at": batch.topics,
+            "changes": batch.changes,
+            "removed": tuple(batch.removed),
+            # Empfangszeit der ältesten Nachricht im Batch (für die Ingest->SSE-Latenz)
+            "received_at": batch.received_at,
+        }
+        if batch.samples is not None:
+            update["samples"] = batch.samples
+        metrics.mqtt_ingest_flushes.inc()
+        device.commit(update)
+        message_log.append(device.id, update)
+
+
+def apply_update(update: dict):
+    """
+    Übernimmt ein Change-Set eines anderen Prozesses (Cluster-Worker) mit dessen Version,
+    sodass Last-Event-IDs auf allen Workern gültig sind. Das Gerät steht unter "device"
+    (fehlt es, das Standardgerät). Läuft im Event Loop.
+    """
+    device = get_device(update.get("device", DEFAULT_DEVICE))
+    for key, received_at, value in update.get("samples", ()):
+        device.append_history(key, received_at, value)
+    device.commit(update)
+
+
 # MQTT Callbacks
 def on_connect(client, userdata, flags, rc):
+    global _reconnect_attempt
     if rc == 0:
-        print("Erfolgreich mit MQTT Broker verbunden.")
-        # Abonnieren der Topics nach erfolgreicher Verbindung
+        logger.info("Erfolgreich mit MQTT Broker verbunden.")
+        _reconnect_attempt = 0
+        # Abonnieren der Topics nach erfolgreicher Verbindung (auch nach jedem Reconnect)
         for topic in MQTT_TOPICS:
             client.subscribe(topic)  # QoS 0 per default
-            print(f"Abonniert: {topic}")
+            logger.info("Abonniert: %s", topic)
+        if DEVICE_TOPIC_PREFIX:
+            client.subscribe(DEVICE_TOPIC_PREFIX + "+/#")
+            logger.info("Abonniert: %s+/# (Geräte)", DEVICE_TOPIC_PREFIX)
+        # Offline angenommene Nachrichten in Reihenfolge nachsenden
+        if app_event_loop:
+            _call_in_loop(_flush_outbox)
 
     else:
-        print(f"Verbindung zum MQTT Broker fehlgeschlagen mit Code: {rc}")
+        logger.error("Verbindung zum MQTT Broker fehlgeschlagen mit Code: %s", rc)
+    if app_event_loop:
+        _call_in_loop(_resolve_connect_waiters, rc == 0)
 
 
 def on_message(client, userdata, msg):
-    payload_str = msg.payload.decode()
-    original_topic = msg.topic  # Behalte den ursprünglichen Topic für das Update-Signal
-    print(
-        f"MQTT_CLIENT: Nachricht empfangen auf Topic '{original_topic}': {payload_str}")
-
-    sse_topic_to_signal = original_topic
-    sse_payload_to_signal = payload_str
-
-    with latest_messages_lock:
-        if original_topic == "innen":
-            try:
-                parts = payload_str.split('-')
-                if len(parts) == 3:
-                    temp, humidity, pressure = parts
-                    latest_messages["indoor/temperature"] = temp.strip()
-                    latest_messages["indoor/humidity"] = humidity.strip()
-                    latest_messages["indoor/pressure"] = pressure.strip()
-                    # Entferne den ursprünglichen "innen" Topic, da er aufgeteilt wurde
-                    if "innen" in latest_messages:
-                        del latest_messages["innen"]
-                    print(
-                        f"MQTT_CLIENT: Topic 'innen' Daten '{payload_str}' verarbeitet.")
-                    # SSE signal will use original_topic="innen"; handler can check for sub-keys
-                else:
-                    print(
-                        f"MQTT_CLIENT: WARNUNG - 'innen' Topic Payload Formatfehler. Speichere original.")
-                    # Speichere die Originalnachricht bei Formatfehler
-                    latest_messages[original_topic] = payload_str
-            except Exception as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Parsen des 'innen' Topic Payloads '{payload_str}': {e}. Speichere original.")
-                # Speichere die Originalnachricht bei Exception
-                latest_messages[original_topic] = payload_str
-        elif original_topic == "send_settings":
-            # Rohen Payload für Anzeige speichern
-            latest_messages["send_settings_payload"] = payload_str
-            try:
-                settings_data = json.loads(payload_str)
-                if isinstance(settings_data, dict):
-                    for key, value in settings_data.items():
-                        latest_messages[f"setting_{key}"] = value
-                    print(
-                        f"MQTT_CLIENT: Topic 'send_settings' Daten verarbeitet und als 'setting_KEY' gespeichert.")
-                    sse_topic_to_signal = "send_settings"  # Spezifisches Signal für SSE Handler
-                    # Anzeigen, dass Daten geparst und bereit sind
-                    sse_payload_to_signal = "updated"
-                else:
-                    print(
-                        f"MQTT_CLIENT: WARNUNG - 'send_settings' Payload ist kein JSON-Objekt. Speichere original unter '{original_topic}'.")
-                    latest_messages[original_topic] = payload_str  # Fallback
-            except json.JSONDecodeError as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Parsen des 'send_settings' JSON Payloads: {e}. Speichere original unter '{original_topic}'.")
-                latest_messages[original_topic] = payload_str
-            except Exception as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Verarbeiten des 'send_settings' Payloads: {e}. Speichere original unter '{original_topic}'.")
-                latest_messages[original_topic] = payload_str
-        else:
-            # Standardbehandlung für alle anderen Topics
-            latest_messages[original_topic] = payload_str
-
-    # Informiere den SSE-Handler über die neue Nachricht
-    if app_event_loop and update_queue:
-        asyncio.run_coroutine_threadsafe(update_queue.put(
-            {"type": "update", "topic": sse_topic_to_signal, "payload": sse_payload_to_signal}), app_event_loop)
+    global _flush_scheduled
+    try:
+        payload_str = msg.payload.decode()
+    except UnicodeDecodeError:
+        # Eine Exception im paho-Thread würde die Verarbeitung abbrechen; ungültige Bytes werden ersetzt
+        payload_str = msg.payload.decode(errors="replace")
+        metrics.mqtt_decode_errors.inc(msg.topic)
+        logger.warning("Payload auf Topic '%s' ist kein gültiges UTF-8.", msg.topic, extra={"topic": msg.topic})
+    # Läuft für jede Nachricht: ohne aktiviertes DEBUG-Level nur ein Level-Vergleich
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Nachricht empfangen auf Topic '%s': %s", msg.topic, payload_str, extra={"topic": msg.topic})
+
+    received_at = time.time()
+    metrics.mqtt_messages_received.inc(msg.topic)
+    # Typisierte Werte einmalig hier (im paho-Thread bzw. Event Loop) über die Decoder-Registry parsen
+    # Decoder und Keys arbeiten mit dem Topic ohne Geräte-Präfix
+    device_id, topic = split_device_topic(msg.topic)
+    changes, removed, numeric = decoders.decode(topic, payload_str)
+    _ingest_buffer.append((device_id, topic, changes, removed, numeric, received_at))
+
+    # Höchstens einen Flush gleichzeitig im Event Loop einplanen
+    if not _flush_scheduled and app_event_loop:
+        _flush_scheduled = True
+        _call_in_loop(_schedule_flush)
 
 
 def on_disconnect(client, userdata, rc):
-    print(f"Verbindung zum MQTT Broker getrennt mit Code: {rc}")
-    if rc != 0:
-        print("Versuche erneute Verbindung...")
-        # Einfacher Wiederverbindungsversuch (kann verbessert werden, z.B. mit Backoff)
-        # time.sleep(5)
-        # client.reconnect() # Vorsicht mit automatischem Reconnect in Schleife ohne Backoff
+    logger.warning("Verbindung zum MQTT Broker getrennt mit Code: %s", rc)
+    if rc != 0 and not _stopping and app_event_loop:
+        _call_in_loop(_start_reconnect)
+
+
+# Verbindungsmanager: Wiederverbinden mit exponentiellem Backoff und Jitter
+_reconnect_attempt = 0
+_reconnect_task = None
+_stopping = False
+
+
+def reconnect_delay(attempt: int) -> float:
+    delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def _start_reconnect(immediate: bool = False):
+    global _reconnect_task
+    if _reconnect_task is None or _reconnect_task.done():
+        _reconnect_task = app_event_loop.create_task(_reconnect_loop(immediate))
+
+
+async def _reconnect_loop(immediate: bool = False):
+    """Verbindet (erneut), bis es klappt; mit immediate ohne Wartezeit vor dem ersten Versuch."""
+    global _reconnect_attempt
+    while not _stopping and not client.is_connected():
+        if not immediate:
+            delay = reconnect_delay(_reconnect_attempt)
+            _reconnect_attempt += 1
+            logger.info("Versuche erneute Verbindung in %.1f s (Versuch %d)...", delay, _reconnect_attempt)
+            await asyncio.sleep(delay)
+        if _stopping:
+            return
+        try:
+            if transport is not None:
+                # Verbindungsaufbau (DNS, TCP bis 5 s) im Executor; die Socket-Callbacks
+                # registrieren den Socket danach im Event Loop (siehe AsyncioTransport)
+                await asyncio.get_running_loop().run_in_executor(None, client.reconnect)
+            else:
+                client.loop_stop()  # beendeten Netzwerk-Thread aufräumen
+                await asyncio.get_running_loop().run_in_executor(None, client.reconnect)
+                client.loop_start()
+            if not immediate:
+                metrics.mqtt_reconnects.inc()
+            return
+        except OSError as e:
+            logger.warning("Verbindung fehlgeschlagen: %s", e)
+        immediate = False
+
+
+# Futures, die auf das nächste CONNACK warten (siehe wait_until_connected)
+_connect_waiters = []
+
+
+def _resolve_connect_waiters(connected: bool):
+    while _connect_waiters:
+        future = _connect_waiters.pop()
+        if not future.done():
+            future.set_result(connected)
+
+
+async def wait_until_connected(timeout: float = None) -> bool:
+    """
+    Wartet, bis on_connect das CONNACK des Brokers meldet. True bei erfolgreicher Verbindung,
+    False bei Ablehnung durch den Broker oder nach `timeout` Sekunden (Standard: CONNECT_TIMEOUT).
+    """
+    if client.is_connected():
+        return True
+    future = asyncio.get_running_loop().create_future()
+    _connect_waiters.append(future)
+    try:
+        return await asyncio.wait_for(future, timeout or CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        if future in _connect_waiters:
+            _connect_waiters.remove(future)
+
+
+# Erstelle den MQTT Client; Wiederverbinden übernimmt der Verbindungsmanager (mit Jitter),
+# nicht der paho-Thread
+client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, reconnect_on_failure=False)
+
+
+class AsyncioTransport:
+    """
+    Treibt den paho-Client ohne eigenen Thread: der Socket wird per add_reader/add_writer
+    im Event Loop überwacht, loop_misc() (Keepalive, Timeouts) läuft als periodischer Task.
+    Alle paho-Callbacks laufen damit im Event Loop. Der Verbindungsaufbau selbst läuft im
+    Executor; Socket-Callbacks aus diesem Thread werden per call_soon_threadsafe übergeben.
+    """
+
+    def __init__(self, mqtt_client, loop):
+        self.client = mqtt_client
+        self.loop = loop
+        self._misc_task = None
+        mqtt_client.on_socket_open = self.on_socket_open
+        mqtt_client.on_socket_close = self.on_socket_close
+        mqtt_client.on_socket_register_write = self.on_socket_register_write
+        mqtt_client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _in_loop(self, callback, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
 
-# Erstelle den MQTT Client
-client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    def on_socket_open(self, client, userdata, sock):
+        # File-Deskriptor statt Socket: beim Ausführen im Loop kann der Socket bereits geschlossen sein
+        self._in_loop(self._open, sock.fileno())
 
-# Setze die Callbacks
-client.on_connect = on_connect
-client.on_message = on_message
-client.on_disconnect = on_disconnect
+    def _open(self, fd):
+        self.loop.add_reader(fd, self.client.loop_read)
+        if self._misc_task is None:
+            self._misc_task = self.loop.create_task(self._misc_loop())
 
-# MQTT Callbacks
-def on_message(client, userdata, msg):
-    payload_str = msg.payload.decode()
-    original_topic = msg.topic  # Behalte den ursprünglichen Topic für das Update-Signal
-    print(
-        f"MQTT_CLIENT: Nachricht empfangen auf Topic '{original_topic}': {payload_str}")
+    def on_socket_close(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_reader, sock.fileno())
 
-    sse_topic_to_signal = original_topic
-    sse_payload_to_signal = payload_str
+    def on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, sock.fileno(), client.loop_write)
 
-    with latest_messages_lock:
-        if original_topic == "innen":
-            try:
-                parts = payload_str.split('-')
-                if len(parts) == 3:
-                    temp, humidity, pressure = parts
-                    latest_messages["indoor/temperature"] = temp.strip()
-                    latest_messages["indoor/humidity"] = humidity.strip()
-                    latest_messages["indoor/pressure"] = pressure.strip()
-                    # Entferne den ursprünglichen "innen" Topic, da er aufgeteilt wurde
-                    if "innen" in latest_messages:
-                        del latest_messages["innen"]
-                    print(
-                        f"MQTT_CLIENT: Topic 'innen' Daten '{payload_str}' verarbeitet.")
-                    # SSE signal will use original_topic="innen"; handler can check for sub-keys
-                else:
-                    print(
-                        f"MQTT_CLIENT: WARNUNG - 'innen' Topic Payload Formatfehler. Speichere original.")
-                    # Speichere die Originalnachricht bei Formatfehler
-                    latest_messages[original_topic] = payload_str
-            except Exception as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Parsen des 'innen' Topic Payloads '{payload_str}': {e}. Speichere original.")
-                # Speichere die Originalnachricht bei Exception
-                latest_messages[original_topic] = payload_str
-        elif original_topic == "send_settings":
-            # Rohen Payload für Anzeige speichern
-            latest_messages["send_settings_payload"] = payload_str
-            try:
-                settings_data = json.loads(payload_str)
-                if isinstance(settings_data, dict):
-                    for key, value in settings_data.items():
-                        latest_messages[f"setting_{key}"] = value
-                    print(
-                        f"MQTT_CLIENT: Topic 'send_settings' Daten verarbeitet und als 'setting_KEY' gespeichert.")
-                    sse_topic_to_signal = "send_settings"  # Spezifisches Signal für SSE Handler
-                    # Anzeigen, dass Daten geparst und bereit sind
-                    sse_payload_to_signal = "updated"
-                else:
-                    print(
-                        f"MQTT_CLIENT: WARNUNG - 'send_settings' Payload ist kein JSON-Objekt. Speichere original unter '{original_topic}'.")
-                    latest_messages[original_topic] = payload_str  # Fallback
-            except json.JSONDecodeError as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Parsen des 'send_settings' JSON Payloads: {e}. Speichere original unter '{original_topic}'.")
-                latest_messages[original_topic] = payload_str
-            except Exception as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Verarbeiten des 'send_settings' Payloads: {e}. Speichere original unter '{original_topic}'.")
-                latest_messages[original_topic] = payload_str
-        else:
-            # Standardbehandlung für alle anderen Topics
-            latest_messages[original_topic] = payload_str
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_writer, sock.fileno())
 
-    # Informiere den SSE-Handler über die neue Nachricht
-    if app_event_loop and update_queue:
-        asyncio.run_coroutine_threadsafe(update_queue.put(
-            {"type": "update", "topic": sse_topic_to_signal, "payload": sse_payload_to_signal}), app_event_loop)
+    async def _misc_loop(self):
+        try:
+            while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(1)
+        finally:
+            self._misc_task = None
 
+    def stop(self):
+        if self._misc_task is not None:
+            self._misc_task.cancel()
 
-def on_disconnect(client, userdata, rc):
-    print(f"Verbindung zum MQTT Broker getrennt mit Code: {rc}")
-    if rc != 0:
-        print("Versuche erneute Verbindung...")
-        # Einfacher Wiederverbindungsversuch (kann verbessert werden, z.B. mit Backoff)
-        # time.sleep(5)
-        # client.reconnect() # Vorsicht mit automatischem Reconnect in Schleife ohne Backoff
 
+# Gesetzt, wenn MQTT_TRANSPORT == "asyncio"
+transport = None
 
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        print("Erfolgreich mit MQTT Broker verbunden.")
-        # Abonnieren der Topics nach erfolgreicher Verbindung
-        for topic in MQTT_TOPICS:
-            client.subscribe(topic)  # QoS 0 per default
-            print(f"Abonniert: {topic}")
 
+def _call_in_loop(callback, *args):
+    """Plant callback im Event Loop ein; ohne Thread-Wechsel, wenn paho selbst im Event Loop läuft."""
+    if transport is not None:
+        app_event_loop.call_soon(callback, *args)
     else:
-        print(f"Verbindung zum MQTT Broker fehlgeschlagen mit Code: {rc}")
-
-#
+        app_event_loop.call_soon_threadsafe(callback, *args)
 
 
-def on_message(client, userdata, msg):
-    payload_str = msg.payload.decode()
-    original_topic = msg.topic  # Behalte den ursprünglichen Topic für das Update-Signal
-    print(
-        f"MQTT_CLIENT: Nachricht empfangen auf Topic '{original_topic}': {payload_str}")
+# Setze die Callbacks
+client.on_connect = on_connect
+client.on_message = on_message
+client.on_disconnect = on_disconnect
 
-    sse_topic_to_signal = original_topic
-    sse_payload_to_signal = payload_str
 
-    with latest_messages_lock:
-        if original_topic == "innen":
-            try:
-                parts = payload_str.split('-')
-                if len(parts) == 3:
-                    temp, humidity, pressure = parts
-                    latest_messages["indoor/temperature"] = temp.strip()
-                    latest_messages["indoor/humidity"] = humidity.strip()
-                    latest_messages["indoor/pressure"] = pressure.strip()
-                    # Entferne den ursprünglichen "innen" Topic, da er aufgeteilt wurde
-                    if "innen" in latest_messages:
-                        del latest_messages["innen"]
-                    print(
-                        f"MQTT_CLIENT: Topic 'innen' Daten '{payload_str}' verarbeitet.")
-                    # SSE signal will use original_topic="innen"; handler can check for sub-keys
-                else:
-                    print(
-                        f"MQTT_CLIENT: WARNUNG - 'innen' Topic Payload Formatfehler. Speichere original.")
-                    # Speichere die Originalnachricht bei Formatfehler
-                    latest_messages[original_topic] = payload_str
-            except Exception as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Parsen des 'innen' Topic Payloads '{payload_str}': {e}. Speichere original.")
-                # Speichere die Originalnachricht bei Exception
-                latest_messages[original_topic] = payload_str
-        elif original_topic == "send_settings":
-            # Rohen Payload für Anzeige speichern
-            latest_messages["send_settings_payload"] = payload_str
-            try:
-                settings_data = json.loads(payload_str)
-                if isinstance(settings_data, dict):
-                    for key, value in settings_data.items():
-                        latest_messages[f"setting_{key}"] = value
-                    print(
-                        f"MQTT_CLIENT: Topic 'send_settings' Daten verarbeitet und als 'setting_KEY' gespeichert.")
-                    sse_topic_to_signal = "send_settings"  # Spezifisches Signal für SSE Handler
-                    # Anzeigen, dass Daten geparst und bereit sind
-                    sse_payload_to_signal = "updated"
-                else:
-                    print(
-                        f"MQTT_CLIENT: WARNUNG - 'send_settings' Payload ist kein JSON-Objekt. Speichere original unter '{original_topic}'.")
-                    latest_messages[original_topic] = payload_str  # Fallback
-            except json.JSONDecodeError as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Parsen des 'send_settings' JSON Payloads: {e}. Speichere original unter '{original_topic}'.")
-                latest_messages[original_topic] = payload_str
-            except Exception as e:
-                print(
-                    f"MQTT_CLIENT: FEHLER - Beim Verarbeiten des 'send_settings' Payloads: {e}. Speichere original unter '{original_topic}'.")
-                latest_messages[original_topic] = payload_str
+def on_publish(client, userdata, mid):
+    # Läuft im paho-Thread (bzw. Event Loop); die Zuordnung zum Future erfolgt im Event Loop
+    if app_event_loop:
+        _call_in_loop(_resolve_publish, mid)
+
+
+client.on_publish = on_publish
+
+# Standard-Timeout für die Bestätigung eines Publish (Sekunden)
+PUBLISH_TIMEOUT = 10
+# Im Cluster-Worker: Funktion (topic, payload, qos, retain) -> Future, die Publishes
+# an den Ingest-Prozess weiterreicht (dieser Prozess hat dann keine eigene MQTT-Verbindung);
+# mit status=True liefert das Future den Zustellstatus (siehe send_message_status)
+remote_publisher = None
+# Laufende Publishes: paho message id -> (asyncio.Future, Startzeit)
+_pending_publishes = {}
+metrics.Gauge("mqtt_pending_publishes", "Publishes, deren Bestätigung noch aussteht.",
+              collect=lambda: {(): len(_pending_publishes)})
+
+# Offline angenommene Publishes (optional auf Platte gespoolt, siehe app/outbox.py)
+outbox = Outbox()
+metrics.Gauge("mqtt_outbox_depth", "Offline gepufferte Nachrichten, die auf das Wiederverbinden warten.",
+              collect=lambda: {(): len(outbox)})
+
+
+def _resolve_publish(mid):
+    future, started = _pending_publishes.pop(mid, (None, None))
+    if future is not None and not future.done():
+        metrics.publish_roundtrip_seconds.observe(time.perf_counter() - started)
+        future.set_result(True)
+
+
+def _forget_publish(mid, future):
+    # Eintrag nur entfernen, wenn die mid nicht schon für einen neuen Publish vergeben wurde
+    if _pending_publishes.get(mid, (None,))[0] is future:
+        del _pending_publishes[mid]
+
+
+def _check_topic(topic):
+    if not is_valid_topic(topic):
+        raise ValueError(f"Ungültiges Topic zum Senden: '{topic}'")
+
+
+def publish_message_async(topic, payload, qos=0, retain=False) -> asyncio.Future:
+    """
+    Sendet eine Nachricht nicht-blockierend und gibt ein asyncio.Future zurück.
+    Das Future wird mit True erfüllt, sobald paho den Publish bestätigt
+    (QoS 0: geschrieben, QoS 1: PUBACK, QoS 2: PUBCOMP), bzw. mit False,
+    wenn paho einen Fehler meldet.
+    Ohne Verbindung wird die Nachricht in der Outbox gepuffert und nach dem Wiederverbinden
+    gesendet; das Future bleibt bis dahin offen (sofort False, wenn die Outbox voll ist).
+    Ein Abbrechen des Futures zieht eine gepufferte Nachricht zurück.
+    Muss im Event Loop aufgerufen werden. Ungültige Topics (leer, mit Wildcards) ergeben
+    einen ValueError, bevor die Nachricht gesendet oder gepuffert wird.
+    """
+    _check_topic(topic)
+    if remote_publisher is not None:
+        return remote_publisher(topic, payload, qos, retain)
+    future = asyncio.get_running_loop().create_future()
+    # Solange die Outbox nicht leer ist, auch neue Nachrichten einreihen (Reihenfolge bleibt erhalten)
+    if not client.is_connected() or outbox:
+        if not outbox.put(topic, payload, qos, retain, future):
+            logger.warning("MQTT Client ist nicht verbunden und die Outbox ist voll. "
+                           "Nachricht konnte nicht gesendet werden.")
+            future.set_result(False)
+        elif client.is_connected():
+            _flush_outbox()
         else:
-            # Standardbehandlung für alle anderen Topics
-            latest_messages[original_topic] = payload_str
-
-    # Informiere den SSE-Handler über die neue Nachricht
-    if app_event_loop and update_queue:
-        asyncio.run_coroutine_threadsafe(update_queue.put(
-            {"type": "update", "topic": sse_topic_to_signal, "payload": sse_payload_to_signal}), app_event_loop)
-
-
-def on_disconnect(client, userdata, rc):
-    print(f"Verbindung zum MQTT Broker getrennt mit Code: {rc}")
-    if rc != 0:
-        print("Versuche erneute Verbindung...")
-        # Einfacher Wiederverbindungsversuch (kann verbessert werden, z.B. mit Backoff)
-        # time.sleep(5)
-        # client.reconnect() # Vorsicht mit automatischem Reconnect in Schleife ohne Backoff
+            logger.info("MQTT Client ist nicht verbunden. Nachricht an Topic '%s' gepuffert (%d wartend).",
+                        topic, len(outbox), extra={"topic": topic})
+        return future
+    return _publish_now(topic, payload, qos, retain, future)
+
+
+def _publish_now(topic, payload, qos, retain, future) -> asyncio.Future:
+    started = time.perf_counter()
+    result = client.publish(topic, payload, qos, retain)
+    if result.rc != mqtt.MQTT_ERR_SUCCESS:
+        logger.error("Fehler beim Senden der Nachricht an Topic '%s': %s", topic, mqtt.error_string(result.rc),
+                     extra={"topic": topic})
+        future.set_result(False)
+        return future
+
+    # on_publish wird per call_soon(_threadsafe) eingeplant und kann daher frühestens
+    # nach dieser (synchronen) Registrierung ausgewertet werden.
+    _pending_publishes[result.mid] = (future, started)
+    future.add_done_callback(lambda f, mid=result.mid: _forget_publish(mid, f))
+    logger.debug("Nachricht '%s' an Topic '%s' gesendet (mid=%d).", payload, topic, result.mid,
+                 extra={"topic": topic})
+    return future
 
 
 def publish_message(topic, payload, qos=0, retain=False):
-    if client.is_connected():
+    """
+    Sendet eine Nachricht ohne auf die Bestätigung zu warten (für synchronen Code).
+    Ohne Verbindung wird sie in der Outbox gepuffert (True, solange dort Platz ist).
+    """
+    _check_topic(topic)
+    if remote_publisher is not None:
+        # Cluster-Worker: Weiterleitung an den Ingest-Prozess (nur im Event Loop möglich)
+        remote_publisher(topic, payload, qos, retain)
+        return True
+    if client.is_connected() and not outbox:
         result = client.publish(topic, payload, qos, retain)
-        result.wait_for_publish()  # Warten bis die Nachricht gesendet wurde (optional)
         if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            print(
-                f"Nachricht '{payload}' erfolgreich an Topic '{topic}' gesendet.")
+            logger.debug("Nachricht '%s' an Topic '%s' gesendet.", payload, topic, extra={"topic": topic})
+            return True
+        logger.error("Fehler beim Senden der Nachricht an Topic '%s': %s", topic, mqtt.error_string(result.rc),
+                     extra={"topic": topic})
+    elif outbox.put(topic, payload, qos, retain):
+        if client.is_connected() and app_event_loop:
+            _call_in_loop(_flush_outbox)
         else:
-            print(
-                f"Fehler beim Senden der Nachricht an Topic '{topic}': {mqtt.error_string(result.rc)}")
+            logger.info("MQTT Client ist nicht verbunden. Nachricht an Topic '%s' gepuffert (%d wartend).",
+                        topic, len(outbox), extra={"topic": topic})
+        return True
     else:
-        print("MQTT Client ist nicht verbunden. Nachricht konnte nicht gesendet werden.")
-
-
-def start_mqtt_client():
+        logger.warning("MQTT Client ist nicht verbunden und die Outbox ist voll. "
+                       "Nachricht konnte nicht gesendet werden.")
+    return False
+
+
+def _flush_outbox():
+    """Sendet die gepufferten Nachrichten in Reihenfolge, solange die Verbindung besteht (Event Loop)."""
+    if not outbox:
+        return
+    count = 0
+    while outbox and client.is_connected():
+        topic, payload, qos, retain, future = outbox.popleft()
+        if future is None:
+            future = app_event_loop.create_future()
+        elif future.done():
+            continue  # vom Aufrufer zurückgezogen
+        _publish_now(topic, payload, qos, retain, future)
+        count += 1
+    outbox.save()
+    logger.info("%d gepufferte Nachrichten gesendet, %d wartend", count, len(outbox))
+
+
+def restore_state():
+    """Stellt den letzten bekannten Zustand aller Geräte aus dem MessageLog wieder her und startet das Log."""
+    states = message_log.load()
+    for device_id in set(states) | set(devices):
+        device = get_device(device_id)
+        version, data = states.get(device_id, (0, {}))
+        if version < device.store.version:
+            # Cluster-Worker, der zum Ingest-Prozess wird: der replizierte Stand ist neuer als das Log
+            version, data = device.store.snapshot
+        device.store.restore(version, data)
+        states[device_id] = (version, data)
+        logger.info("Zustand von Gerät '%s' wiederhergestellt (Version %d, %d Keys)", device_id, version, len(data))
+    message_log.start(states)
+
+
+def start_mqtt_client(background: bool = False):
+    """
+    Stellt den Zustand wieder her und verbindet mit dem Broker. Mit background=True wird nicht
+    auf den Verbindungsaufbau gewartet: der erste Versuch (und bei Fehlern weitere mit Backoff)
+    läuft im Event Loop, Fehler führen nicht zum Abbruch.
+    """
+    global transport
     # app_event_loop wird in main.py gesetzt, bevor diese Funktion aufgerufen wird.
     if not app_event_loop:
-        print("WARNUNG: asyncio event loop wurde nicht im mqtt_client gesetzt. SSE Updates funktionieren möglicherweise nicht.")
+        logger.warning("asyncio event loop wurde nicht im mqtt_client gesetzt. SSE Updates funktionieren möglicherweise nicht.")
+
+    # Letzten Zustand laden, bevor neue Nachrichten eintreffen
+    restore_state()
+    outbox.load()
 
     try:
         # Setze Benutzername und Passwort
         client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-        
+
+        # Die Socket-Callbacks müssen vor dem Verbinden registriert sein
+        if MQTT_TRANSPORT == "asyncio" and transport is None:
+            transport = AsyncioTransport(client, app_event_loop)
+
         # Verbinde mit dem Broker
-        print(f"Verbinde mit MQTT Broker {MQTT_BROKER_HOST}:{MQTT_BROKER_PORT}")
+        logger.info("Verbinde mit MQTT Broker %s:%s", MQTT_BROKER_HOST, MQTT_BROKER_PORT)
+        if background:
+            # Setzt nur die Verbindungsparameter; verbunden wird im Verbindungsmanager
+            client.connect_async(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
+            _start_reconnect(immediate=True)
+            return
         client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
-        
-        # Starte den Netzwerk-Loop in einem separaten Thread
-        client.loop_start()
-        print("MQTT Client Loop gestartet")
+
+        if transport is not None:
+            logger.info("MQTT Client läuft im asyncio Event Loop")
+        else:
+            # Starte den Netzwerk-Loop in einem separaten Thread
+            client.loop_start()
+            logger.info("MQTT Client Loop gestartet")
     except Exception as e:
-        print(f"Fehler beim Verbinden oder Starten des MQTT Clients: {e}")
+        logger.error("Fehler beim Verbinden oder Starten des MQTT Clients: %s", e)
         raise
 
 
 def stop_mqtt_client():
-    print("MQTT Client wird gestoppt.")
-    client.loop_stop()  # Stoppt den Netzwerk-Loop-Thread
-    client.disconnect()
+    global _stopping
+    logger.info("MQTT Client wird gestoppt.")
+    _stopping = True
+    if _reconnect_task is not None:
+        _reconnect_task.cancel()
+    if transport is not None:
+        client.disconnect()
+        transport.stop()
+    else:
+        client.loop_stop()  # Stoppt den Netzwerk-Loop-Thread
+        client.disconnect()
+    message_log.stop()  # Schreibt die restlichen Change-Sets und einen Snapshot
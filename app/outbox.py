@@ -0,0 +1,74 @@
+import collections
+import json
+import logging
+import os
+
+# Maximale Anzahl Nachrichten, die ohne Verbindung zum Broker gepuffert werden
+OUTBOX_SIZE = 1000
+# Optional: Datei, in der gepufferte Nachrichten einen Neustart überstehen (None = nur im Speicher)
+OUTBOX_SPOOL = None
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Begrenzte FIFO-Queue für Publishes, die ohne Verbindung zum Broker angenommen wurden.
+    Einträge sind (topic, payload, qos, retain, future); future ist None für Einträge ohne
+    wartenden Aufrufer (publish_message oder aus dem Spool geladen).
+    Mit spool_path wird jeder Eintrag zusätzlich als JSON-Zeile angehängt; nach dem Senden
+    schreibt save() die Datei mit den verbliebenen Einträgen neu.
+    """
+
+    def __init__(self, maxsize: int = None, spool_path: str = None):
+        self.maxsize = maxsize or OUTBOX_SIZE
+        self.spool_path = spool_path if spool_path is not None else OUTBOX_SPOOL
+        self._entries = collections.deque()
+        self._futures = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, topic, payload, qos=0, retain=False, future=None) -> bool:
+        """Reiht eine Nachricht ein; False, wenn die Outbox voll ist."""
+        if len(self._entries) >= self.maxsize:
+            return False
+        self._entries.append((topic, payload, qos, retain, future))
+        if future is not None:
+            self._futures.add(future)
+        if self.spool_path:
+            with open(self.spool_path, "a") as spool:
+                spool.write(json.dumps([topic, payload, qos, retain]) + "\n")
+        return True
+
+    def popleft(self):
+        entry = self._entries.popleft()
+        self._futures.discard(entry[4])
+        return entry
+
+    def is_queued(self, future) -> bool:
+        return future in self._futures
+
+    def load(self):
+        """Übernimmt die Einträge aus dem Spool (beim Start, vor dem ersten Verbinden)."""
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path) as spool:
+            for line in spool:
+                try:
+                    topic, payload, qos, retain = json.loads(line)
+                except ValueError:
+                    logger.warning("Ungültiger Eintrag im Outbox-Spool ignoriert: %r", line)
+                    continue
+                if len(self._entries) < self.maxsize:
+                    self._entries.append((topic, payload, qos, retain, None))
+        if self._entries:
+            logger.info("%d gepufferte Nachrichten aus %s geladen", len(self._entries), self.spool_path)
+
+    def save(self):
+        """Schreibt den Spool mit den noch nicht gesendeten Einträgen neu."""
+        if not self.spool_path:
+            return
+        with open(self.spool_path, "w") as spool:
+            for topic, payload, qos, retain, _ in self._entries:
+                spool.write(json.dumps([topic, payload, qos, retain]) + "\n")
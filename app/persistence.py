@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Datei für den dauerhaften Zustand (SQLite im WAL-Modus)
+DB_PATH = os.environ.get("MQTT_STATE_DB", "mqtt_state.db")
+# Nach so vielen Change-Sets wird ein Snapshot geschrieben und das Log gekürzt
+SNAPSHOT_EVERY = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class MessageLog:
+    """
+    Append-only Log der Change-Sets plus periodischer Snapshot in SQLite, pro Gerät
+    (jedes Gerät hat eigene Versionen). append() legt ein Change-Set nur in eine Queue;
+    ein Hintergrund-Thread schreibt gesammelt (ein Commit pro Batch). Beim Start wird der
+    letzte Zustand jedes Geräts aus Snapshot + nachfolgenden Log-Einträgen wiederhergestellt.
+    """
+
+    def __init__(self, path: str = DB_PATH, snapshot_every: int = SNAPSHOT_EVERY):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS device_log (device TEXT, version INTEGER, ts REAL, changes TEXT, "
+            "removed TEXT, PRIMARY KEY (device, version))")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS device_snapshot (device TEXT PRIMARY KEY, version INTEGER, state TEXT)")
+        return connection
+
+    def load(self) -> dict:
+        """Gibt {Geräte-ID: (Version, Zustand)} aus den Snapshots und anschließendem Log zurück."""
+        connection = self._connect()
+        try:
+            result = {device: (version, json.loads(state)) for device, version, state in
+                      connection.execute("SELECT device, version, state FROM device_snapshot")}
+            for device, entry_version, changes, removed in connection.execute(
+                    "SELECT device, version, changes, removed FROM device_log ORDER BY device, version"):
+                version, state = result.get(device, (0, {}))
+                if entry_version <= version:
+                    continue
+                for key in json.loads(removed):
+                    state.pop(key, None)
+                state.update(json.loads(changes))
+                result[device] = (entry_version, state)
+            return result
+        finally:
+            connection.close()
+
+    def start(self, states: dict):
+        """Startet den Schreib-Thread; states entspricht dem Ergebnis von load()."""
+        states = {device: (version, dict(state)) for device, (version, state) in states.items()}
+        self._thread = threading.Thread(target=self._run, args=(states,), name="mqtt-message-log", daemon=True)
+        self._thread.start()
+
+    def append(self, device: str, update: dict):
+        """Nicht-blockierend: übergibt ein Change-Set eines Geräts an den Schreib-Thread (falls gestartet)."""
+        if self._thread is not None:
+            self._queue.put((device, update))
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, states):
+        connection = self._connect()
+        since_snapshot = {}  # Gerät -> Change-Sets seit dem letzten Snapshot
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            # Alles bereits Wartende in denselben Commit nehmen
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+
+            try:
+                now = time.time()
+                connection.executemany(
+                    "INSERT OR REPLACE INTO device_log (device, version, ts, changes, removed) VALUES (?, ?, ?, ?, ?)",
+                    [(device, update["version"], now, json.dumps(update["changes"]),
+                      json.dumps(list(update["removed"]))) for device, update in batch])
+                for device, update in batch:
+                    version, state = states.setdefault(device, (0, {}))
+                    for key in update["removed"]:
+                        state.pop(key, None)
+                    state.update(update["changes"])
+                    states[device] = (update["version"], state)
+                    since_snapshot[device] = since_snapshot.get(device, 0) + 1
+
+                for device, count in list(since_snapshot.items()):
+                    if count >= self.snapshot_every or not running:
+                        version, state = states[device]
+                        connection.execute(
+                            "INSERT OR REPLACE INTO device_snapshot (device, version, state) VALUES (?, ?, ?)",
+                            (device, version, json.dumps(state)))
+                        connection.execute("DELETE FROM device_log WHERE device = ? AND version <= ?",
+                                           (device, version))
+                        del since_snapshot[device]
+                connection.commit()
+            except Exception as e:
+                logger.error("Fehler beim Schreiben: %s", e)
+        connection.close()
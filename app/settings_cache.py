@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+
+from app import mqtt_client
+
+logger = logging.getLogger(__name__)
+
+# So lange gelten die zuletzt empfangenen Einstellungen als aktuell (Sekunden);
+# solange wird beim Öffnen der Einstellungsseite kein neues REQUEST_SETTINGS gesendet
+SETTINGS_TTL = 60
+# So lange wartet eine Anfrage auf die Antwort 'send_settings'; danach darf erneut angefragt werden
+SETTINGS_REQUEST_TIMEOUT = 5
+# Key im Zustand, den der Decoder bei jeder Antwort auf 'send_settings' setzt
+SETTINGS_KEY = "send_settings_payload"
+# Topic der Antwort (ohne Geräte-Präfix)
+SETTINGS_TOPIC = "send_settings"
+
+
+class SettingsCache:
+    """
+    Fordert die ESP32-Einstellungen höchstens einmal pro Freshness-Fenster an.
+    Gleichzeitige Anfragen teilen sich ein REQUEST_SETTINGS (single-flight): alle Aufrufer
+    bekommen dasselbe Future, das mit True erfüllt wird, sobald die Antwort 'send_settings'
+    eintrifft, bzw. mit False nach request_timeout.
+    Als Antwort zählt die erste 'send_settings'-Nachricht, die nach dem Senden der Anfrage
+    empfangen wurde (das Protokoll des ESP32 kennt keine Korrelations-ID).
+    Jedes Gerät hat einen eigenen Cache (siehe cache_for_device()).
+    Alle Methoden laufen im asyncio Event Loop.
+    """
+
+    def __init__(self, device: mqtt_client.Device = None, ttl: float = None, request_timeout: float = None):
+        self.device = device or mqtt_client.default_device
+        self.ttl = SETTINGS_TTL if ttl is None else ttl
+        self.request_timeout = SETTINGS_REQUEST_TIMEOUT if request_timeout is None else request_timeout
+        self.received_at = None  # Empfangszeit der letzten Antwort (Unix-Sekunden)
+        self.requested_at = None  # Sendezeit der laufenden bzw. letzten Anfrage
+        self.requests = 0  # tatsächlich gesendete REQUEST_SETTINGS
+        self._inflight = None
+        self._published = None  # Future des letzten REQUEST_SETTINGS-Publish
+        self._task = None
+
+    @property
+    def pending(self) -> bool:
+        return self._inflight is not None
+
+    def is_fresh(self) -> bool:
+        return self.received_at is not None and time.time() - self.received_at < self.ttl
+
+    def request(self) -> asyncio.Future:
+        """
+        Fordert die Einstellungen an, sofern sie nicht mehr frisch sind und keine Anfrage läuft.
+        Bei frischen Einstellungen ist das zurückgegebene Future bereits mit True erfüllt.
+        Wartet das letzte REQUEST_SETTINGS noch auf das Senden (offline in der Outbox), wird
+        kein weiteres eingereiht; die Anfrage wartet dann auf die Antwort auf das gepufferte.
+        """
+        if self._inflight is not None:
+            return self._inflight
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if self.is_fresh():
+            future.set_result(True)
+            return future
+
+        self._inflight = future
+        timeout = loop.call_later(self.request_timeout, self._finish, future, False)
+        future.add_done_callback(lambda f: timeout.cancel())
+        if self._published is not None and not self._published.done():
+            logger.info("REQUEST_SETTINGS an Gerät '%s' wartet noch auf das Senden.", self.device.id)
+            return future
+
+        self.requested_at = time.time()
+        self.requests += 1
+        published = self._published = mqtt_client.publish_message_async(
+            self.device.topic("settings"), "REQUEST_SETTINGS")
+        published.add_done_callback(self._on_published)
+        logger.info("REQUEST_SETTINGS gesendet, um Einstellungen von Gerät '%s' anzufordern.", self.device.id)
+        return future
+
+    def _on_published(self, published: asyncio.Future):
+        if published.cancelled() or not published.result():
+            logger.warning("REQUEST_SETTINGS konnte nicht gesendet werden.")
+            # Die laufende Anfrage wartet auf dieses (ggf. früher gepufferte) REQUEST_SETTINGS
+            if self._inflight is not None:
+                self._finish(self._inflight, False)
+
+    def _finish(self, future: asyncio.Future, received: bool):
+        if self._inflight is future:
+            self._inflight = None
+        if not future.done():
+            future.set_result(received)
+        if not received:
+            logger.warning("Keine Antwort auf REQUEST_SETTINGS innerhalb von %s s.", self.request_timeout)
+
+    def on_settings(self, received_at: float = None):
+        """Vermerkt eine empfangene 'send_settings'-Nachricht und beendet eine laufende Anfrage."""
+        # Replizierte Snapshots (Cluster) tragen keine Empfangszeit
+        received_at = received_at or time.time()
+        self.received_at = max(received_at, self.received_at or 0)
+        if self._inflight is not None and received_at >= self.requested_at:
+            self._finish(self._inflight, True)
+
+    def observe(self, update: dict):
+        """
+        Wertet ein Change-Set aus. Mehrfaches Auswerten desselben Updates ist unschädlich, daher
+        können SSE-Streams es vor dem Rendern selbst aufrufen, ohne auf _watch() zu warten.
+        Maßgeblich ist die Empfangszeit der 'send_settings'-Nachricht selbst, nicht die des
+        Updates (das ist die älteste Nachricht im Ingest-Batch).
+        """
+        if SETTINGS_KEY in update["changes"]:
+            self.on_settings(update.get("topic_received_at", {}).get(SETTINGS_TOPIC))
+
+    async def _watch(self):
+        with self.device.update_hub.subscription((SETTINGS_KEY,), stream="settings_cache") as updates:
+            while True:
+                self.observe(await updates.get())
+
+    def start(self):
+        # Referenz halten, sonst kann der Task vom Garbage Collector eingesammelt werden
+        self._task = asyncio.create_task(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+settings_cache = SettingsCache()
+# Geräte-ID -> SettingsCache
+_caches = {mqtt_client.DEFAULT_DEVICE: settings_cache}
+
+
+def cache_for_device(device: mqtt_client.Device) -> SettingsCache:
+    """Der Cache eines Geräts; wird beim ersten Zugriff angelegt und beobachtet ab dann dessen Antworten."""
+    cache = _caches.get(device.id)
+    if cache is None:
+        cache = _caches[device.id] = SettingsCache(device)
+        cache.start()
+    return cache
+
+
+def stop_all():
+    for cache in _caches.values():
+        cache.stop()
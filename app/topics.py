@@ -0,0 +1,111 @@
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie:
+    """
+    Trie über MQTT-Topic-Filter (Ebenen getrennt durch '/', Wildcards '+' und '#').
+    match() läuft die Ebenen eines Topics ab; die Kosten hängen von der Topic-Tiefe ab,
+    nicht von der Anzahl der gespeicherten Filter.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, topic_filter: str, value):
+        if not is_valid_filter(topic_filter):
+            raise ValueError(f"Ungültiger Topic-Filter: '{topic_filter}'")
+        node = self._root
+        for level in topic_filter.split('/'):
+            node = node.children.setdefault(level, _Node())
+        node.values.append(value)
+        self._size += 1
+
+    def remove(self, topic_filter: str, value):
+        path = [self._root]
+        levels = topic_filter.split('/')
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        try:
+            path[-1].values.remove(value)
+        except ValueError:
+            return
+        self._size -= 1
+        # Leere Äste wieder entfernen
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if node.values or node.children:
+                break
+            del parent.children[level]
+
+    def match(self, topic: str) -> list:
+        """Alle Werte, deren Filter auf `topic` passt."""
+        levels = topic.split('/')
+        result = []
+        nodes = [self._root]
+        # Wildcards passen nicht auf Topics, die mit '$' beginnen (z.B. $SYS)
+        wildcards = not topic.startswith('$')
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                if wildcards:
+                    child = node.children.get('+')
+                    if child is not None:
+                        next_nodes.append(child)
+                    child = node.children.get('#')
+                    if child is not None:
+                        result.extend(child.values)
+            if not next_nodes:
+                return result
+            nodes = next_nodes
+            wildcards = True
+        for node in nodes:
+            result.extend(node.values)
+            # 'a/#' passt auch auf 'a' selbst
+            child = node.children.get('#')
+            if child is not None:
+                result.extend(child.values)
+        return result
+
+    def matches(self, topic: str) -> bool:
+        return bool(self.match(topic))
+
+
+def is_valid_filter(topic_filter: str) -> bool:
+    """Prüft einen MQTT-Topic-Filter: '#' nur als letzte Ebene, Wildcards nur als ganze Ebene."""
+    if not topic_filter:
+        return False
+    levels = topic_filter.split('/')
+    for index, level in enumerate(levels):
+        if level == '#':
+            if index != len(levels) - 1:
+                return False
+        elif '#' in level or ('+' in level and level != '+'):
+            return False
+    return True
+
+
+def is_valid_topic(topic: str) -> bool:
+    """Prüft ein Topic zum Senden: nicht leer, ohne Wildcards und Nullzeichen, höchstens 65535 Bytes."""
+    return bool(topic) and not any(c in topic for c in "+#\0") and len(topic.encode()) <= 65535
+
+
+def filter_trie(topic_filters) -> TopicTrie:
+    """Trie, der für jeden der Filter True speichert (für matches())."""
+    trie = TopicTrie()
+    for topic_filter in topic_filters:
+        trie.insert(topic_filter, True)
+    return trie
@@ -0,0 +1,134 @@
+"""
+Minimaler MQTT-3.1.1-Broker für Benchmarks (nur localhost, ohne Authentifizierung und Sessions).
+
+Unterstützt CONNECT, SUBSCRIBE/UNSUBSCRIBE (mit '+'/'#'), PUBLISH mit QoS 0-2 (weitergeleitet
+wird immer mit QoS 0), PINGREQ und DISCONNECT. Retained Messages werden nicht gespeichert.
+"""
+import asyncio
+
+from app.topics import TopicTrie
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode()
+    return len(data).to_bytes(2, "big") + data
+
+
+def encode_publish(topic: str, payload: bytes) -> bytes:
+    body = encode_string(topic) + payload
+    return bytes([PUBLISH << 4]) + encode_length(len(body)) + body
+
+
+def encode_connect(client_id: str, keepalive: int = 60) -> bytes:
+    # Protokoll "MQTT", Level 4, Clean Session
+    body = encode_string("MQTT") + bytes([4, 0x02]) + keepalive.to_bytes(2, "big") + encode_string(client_id)
+    return bytes([CONNECT << 4]) + encode_length(len(body)) + body
+
+
+async def read_packet(reader):
+    header = (await reader.readexactly(1))[0]
+    multiplier, length = 1, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return header, await reader.readexactly(length)
+
+
+class FakeBroker:
+    def __init__(self):
+        self._trie = TopicTrie()
+        self._subscriptions = {}  # writer -> Liste der Filter
+        self._server = None
+        self.port = None
+        self.received = 0
+        self.delivered = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        for writer in list(self._subscriptions):
+            writer.close()
+        await self._server.wait_closed()
+
+    def _forward(self, topic: str, payload: bytes):
+        packet = encode_publish(topic, payload)
+        for writer in set(self._trie.match(topic)):
+            writer.write(packet)
+            self.delivered += 1
+
+    def _unsubscribe_all(self, writer):
+        for topic_filter in self._subscriptions.pop(writer, ()):
+            self._trie.remove(topic_filter, writer)
+
+    async def _handle(self, reader, writer):
+        self._subscriptions[writer] = []
+        try:
+            while True:
+                header, body = await read_packet(reader)
+                packet_type = header >> 4
+                if packet_type == PUBLISH:
+                    qos = (header >> 1) & 0x03
+                    topic_length = int.from_bytes(body[:2], "big")
+                    topic = body[2:2 + topic_length].decode()
+                    position = 2 + topic_length
+                    if qos:
+                        packet_id = body[position:position + 2]
+                        position += 2
+                        writer.write(bytes([(PUBACK if qos == 1 else PUBREC) << 4, 2]) + packet_id)
+                    self.received += 1
+                    self._forward(topic, body[position:])
+                elif packet_type == PUBREL:
+                    writer.write(bytes([PUBCOMP << 4, 2]) + body[:2])
+                elif packet_type == CONNECT:
+                    writer.write(bytes([CONNACK << 4, 2, 0, 0]))
+                elif packet_type == SUBSCRIBE:
+                    granted = bytearray()
+                    position = 2
+                    while position < len(body):
+                        length = int.from_bytes(body[position:position + 2], "big")
+                        topic_filter = body[position + 2:position + 2 + length].decode()
+                        position += 2 + length + 1  # + angefragte QoS
+                        self._trie.insert(topic_filter, writer)
+                        self._subscriptions[writer].append(topic_filter)
+                        granted.append(0)
+                    payload = body[:2] + bytes(granted)
+                    writer.write(bytes([SUBACK << 4]) + encode_length(len(payload)) + payload)
+                elif packet_type == UNSUBSCRIBE:
+                    position = 2
+                    while position < len(body):
+                        length = int.from_bytes(body[position:position + 2], "big")
+                        topic_filter = body[position + 2:position + 2 + length].decode()
+                        position += 2 + length
+                        if topic_filter in self._subscriptions[writer]:
+                            self._subscriptions[writer].remove(topic_filter)
+                            self._trie.remove(topic_filter, writer)
+                    writer.write(bytes([UNSUBACK << 4, 2]) + body[:2])
+                elif packet_type == PINGREQ:
+                    writer.write(bytes([PINGRESP << 4, 0]))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._unsubscribe_all(writer)
+            writer.close()
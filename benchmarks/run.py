@@ -0,0 +1,310 @@
+"""
+End-to-End-Lastmessung: lokaler Fake-Broker, simulierte ESP32-Geräte und SSE-Clients gegen die App.
+
+    python -m benchmarks.run --devices 10 --rate 20 --clients 30 --duration 20
+
+Die App läuft als eigener uvicorn-Prozess gegen den Fake-Broker (mit eigener Zustandsdatenbank
+in einem Temp-Verzeichnis), damit CPU-Zeit und Speicher nur ihr zugerechnet werden. Die Geräte
+senden Zeitstempel als Messwerte; die SSE-Clients messen daraus die Latenz MQTT -> Browser.
+Läuft offline, benötigt aber Linux (CPU und Speicher werden aus /proc gelesen).
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from app.mqtt_client import MQTT_TOPICS
+from benchmarks.fake_broker import FakeBroker, encode_connect, encode_publish, read_packet
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SSE_STREAMS = ("/events/mqtt-updates?mode=delta", "/sse", "/events/new-messages")
+# Jede n-te Nachricht eines Geräts ist ein 'send_settings' (für den /sse Stream)
+SETTINGS_EVERY = 50
+# Zeitstempel (time.time()), die die Geräte als Messwerte senden
+TIMESTAMP = re.compile(rb"1\d{9}\.\d+")
+EVENT_END = re.compile(rb"\r?\n\r?\n")
+
+
+def device_payload(topic: str, now: float) -> bytes:
+    stamp = f"{now:.6f}"
+    if topic == "send_settings":
+        return f'{{"ts": {stamp}, "reStarts": 1}}'.encode()
+    if topic == "innen":
+        return f"{stamp}-55.0-1013.2".encode()
+    return stamp.encode()
+
+
+async def run_device(port: int, index: int, rate: float, stop: asyncio.Event, counter: list):
+    """Ein simuliertes ESP32: sendet mit `rate` Nachrichten pro Sekunde reihum auf MQTT_TOPICS."""
+    topics = [topic for topic in MQTT_TOPICS if topic != "send_settings"]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(encode_connect(f"bench-device-{index}"))
+    await read_packet(reader)  # CONNACK
+
+    loop = asyncio.get_running_loop()
+    interval = 1 / rate
+    # Geräte gleichmäßig über das Intervall verteilen
+    next_send = loop.time() + interval * (index % 100) / 100
+    sent = 0
+    while not stop.is_set():
+        await asyncio.sleep(max(0.0, next_send - loop.time()))
+        next_send += interval
+        if sent % SETTINGS_EVERY == SETTINGS_EVERY - 1:
+            topic = "send_settings"
+        else:
+            topic = topics[sent % len(topics)]
+        writer.write(encode_publish(topic, device_payload(topic, time.time())))
+        sent += 1
+        counter[0] += 1
+        await writer.drain()
+    writer.close()
+
+
+class BrokerThread(threading.Thread):
+    """Fake-Broker und Geräte in einem eigenen Thread mit eigenem Event Loop."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.ready = threading.Event()
+        self.sent = [0]
+        self.broker = None
+        self.loop = None
+        self._stop_devices = None
+        self._done = None
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.broker = await FakeBroker().start()
+        self._stop_devices = asyncio.Event()
+        self._done = self.loop.create_future()
+        self.ready.set()
+        await self._done
+        self._stop_devices.set()
+        await self.broker.stop()
+
+    def start_devices(self, devices: int, rate: float):
+        for index in range(devices):
+            asyncio.run_coroutine_threadsafe(
+                run_device(self.broker.port, index, rate, self._stop_devices, self.sent), self.loop)
+
+    def stop_devices(self):
+        self.loop.call_soon_threadsafe(self._stop_devices.set)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self._done.set_result, None)
+        self.join()
+
+
+class SseClient:
+    def __init__(self, path: str):
+        self.path = path
+        self.events = 0
+        self.latencies = []
+        self.measuring = False
+
+    async def run(self, port: int):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {self.path} HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n".encode())
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass  # Response-Header
+
+        buffer = b""
+        try:
+            while True:
+                # Chunked Transfer-Encoding: Größe (hex), Daten, CRLF
+                size = int((await reader.readline()).strip() or b"0", 16)
+                if size == 0:
+                    return
+                buffer += (await reader.readexactly(size + 2))[:-2]
+                received = time.time()
+                *events, buffer = EVENT_END.split(buffer)
+                for event in events:
+                    stamps = TIMESTAMP.findall(event)
+                    if not stamps:
+                        continue  # Keep-Alive / Ping
+                    self.events += 1
+                    if self.measuring:
+                        # Das Event enthält (mindestens) den neuesten gesendeten Wert
+                        self.latencies.append(received - max(map(float, stamps)))
+        finally:
+            writer.close()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    # utime und stime (Felder 14 und 15 der Gesamtzeile)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def received_total(port: int) -> float:
+    """Summe von mqtt_messages_received_total aus /metrics der App."""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+        text = response.read().decode()
+    return sum(float(line.rsplit(" ", 1)[1]) for line in text.splitlines()
+               if line.startswith("mqtt_messages_received_total"))
+
+
+async def wait_ready(port: int, process, timeout: float = 30):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("App-Prozess wurde beendet")
+        try:
+            await loop.run_in_executor(None, received_total, port)
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("App wurde nicht rechtzeitig bereit")
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def benchmark(args) -> dict:
+    broker_thread = BrokerThread()
+    broker_thread.start()
+    broker_thread.ready.wait()
+
+    port = free_port()
+    state_dir = tempfile.mkdtemp(prefix="mqtt-bench-")
+    env = dict(os.environ,
+               MQTT_BROKER_HOST="127.0.0.1",
+               MQTT_BROKER_PORT=str(broker_thread.broker.port),
+               MQTT_STATE_DB=os.path.join(state_dir, "mqtt_state.db"),
+               MQTT_TRANSPORT=args.transport)
+    app_process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT, env=env,
+        stdout=None if args.verbose else subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL)
+    loop = asyncio.get_running_loop()
+    clients = []
+    client_tasks = []
+    try:
+        await wait_ready(port, app_process)
+        rss_idle = rss_bytes(app_process.pid)
+
+        clients = [SseClient(SSE_STREAMS[i % len(SSE_STREAMS)]) for i in range(args.clients)]
+        client_tasks = [asyncio.create_task(client.run(port)) for client in clients]
+        await asyncio.sleep(1)
+        rss_clients = rss_bytes(app_process.pid)
+
+        broker_thread.start_devices(args.devices, args.rate)
+        await asyncio.sleep(args.warmup)
+
+        received_start = await loop.run_in_executor(None, received_total, port)
+        cpu_start = cpu_seconds(app_process.pid)
+        sent_start = broker_thread.sent[0]
+        started = time.monotonic()
+        for client in clients:
+            client.measuring = True
+
+        await asyncio.sleep(args.duration)
+
+        for client in clients:
+            client.measuring = False
+        elapsed = time.monotonic() - started
+        sent = broker_thread.sent[0] - sent_start
+        cpu = cpu_seconds(app_process.pid) - cpu_start
+        received = await loop.run_in_executor(None, received_total, port) - received_start
+        rss_end = rss_bytes(app_process.pid)
+    finally:
+        broker_thread.stop_devices()
+        for task in client_tasks:
+            task.cancel()
+        await asyncio.gather(*client_tasks, return_exceptions=True)
+        app_process.terminate()
+        app_process.wait()
+        broker_thread.stop()
+
+    latency = {}
+    for path in SSE_STREAMS:
+        values = sorted(v for client in clients if client.path == path for v in client.latencies)
+        latency[path] = {
+            "samples": len(values),
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p90_ms": percentile(values, 0.90) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "max_ms": (values[-1] if values else float("nan")) * 1000,
+        }
+    return {
+        "devices": args.devices,
+        "rate_per_device": args.rate,
+        "sse_clients": args.clients,
+        "transport": args.transport,
+        "sent_per_s": sent / elapsed,
+        "ingest_per_s": received / elapsed,
+        "cpu_us_per_message": cpu / received * 1e6 if received else float("nan"),
+        "cpu_core_share": cpu / elapsed,
+        "rss_idle_mib": rss_idle / 2 ** 20,
+        "rss_end_mib": rss_end / 2 ** 20,
+        "rss_per_client_kib": (rss_clients - rss_idle) / max(1, args.clients) / 1024,
+        "latency": latency,
+    }
+
+
+def print_report(result: dict):
+    print(f"Geräte: {result['devices']} x {result['rate_per_device']:g} msg/s, "
+          f"SSE-Clients: {result['sse_clients']}, Transport: {result['transport']}")
+    print(f"Ingest:   {result['ingest_per_s']:.0f} msg/s (gesendet: {result['sent_per_s']:.0f} msg/s)")
+    print(f"CPU:      {result['cpu_us_per_message']:.1f} µs/msg ({result['cpu_core_share']:.0%} eines Kerns)")
+    print(f"Speicher: {result['rss_per_client_kib']:.1f} KiB pro SSE-Client "
+          f"(RSS ohne Clients {result['rss_idle_mib']:.1f} MiB, am Ende {result['rss_end_mib']:.1f} MiB)")
+    print("Latenz MQTT -> Browser (ms):")
+    print(f"  {'Stream':<36}{'n':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for path, stats in result["latency"].items():
+        print(f"  {path:<36}{stats['samples']:>8}{stats['p50_ms']:>9.1f}{stats['p90_ms']:>9.1f}"
+              f"{stats['p99_ms']:>9.1f}{stats['max_ms']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=10, help="Anzahl simulierter ESP32-Geräte")
+    parser.add_argument("--rate", type=float, default=20, help="Nachrichten pro Sekunde und Gerät")
+    parser.add_argument("--clients", type=int, default=30, help="SSE-Clients (reihum auf die drei Streams)")
+    parser.add_argument("--duration", type=float, default=20, help="Messdauer in Sekunden")
+    parser.add_argument("--warmup", type=float, default=3, help="Einlaufzeit vor der Messung in Sekunden")
+    parser.add_argument("--transport", choices=("thread", "asyncio"), default="thread", help="MQTT_TRANSPORT der App")
+    parser.add_argument("--json", action="store_true", help="Ergebnis als JSON ausgeben (für Vergleiche)")
+    parser.add_argument("--verbose", action="store_true", help="Ausgaben der App anzeigen")
+    args = parser.parse_args()
+
+    result = asyncio.run(benchmark(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
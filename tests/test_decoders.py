@@ -0,0 +1,35 @@
+import pytest
+
+from app import decoders
+
+
+@pytest.mark.parametrize("payload", ["nan", "NaN", "inf", "-inf", "Infinity", "1e999"])
+def test_decode_value_ignoriert_nicht_endliche_werte(payload):
+    changes, removed, numeric = decoders.decode("aussen", payload)
+    assert changes == {"aussen": payload}
+    assert removed == ()
+    assert numeric == {}
+
+
+def test_decode_value_numerisch():
+    assert decoders.decode("aussen", "21.5")[2] == {"aussen": 21.5}
+
+
+def test_decode_innen_ignoriert_nicht_endliche_werte():
+    changes, removed, numeric = decoders.decode("innen", "21.5-nan-inf")
+    assert changes == {"indoor/temperature": "21.5", "indoor/humidity": "nan", "indoor/pressure": "inf"}
+    assert removed == ("innen",)
+    assert numeric == {"indoor/temperature": 21.5}
+
+
+@pytest.mark.parametrize("payload", ['{"a": NaN}', '{"a": -Infinity}', '{"a": 1e999}'])
+def test_decode_settings_verwirft_nicht_endliche_werte(payload):
+    changes, removed, numeric = decoders.decode("send_settings", payload)
+    assert changes == {"send_settings_payload": payload, "send_settings": payload}
+    assert numeric == {}
+
+
+def test_decode_settings_ohne_zeitreihen():
+    changes, removed, numeric = decoders.decode("send_settings", '{"a": 1, "b": "x", "c": true}')
+    assert changes["setting_a"] == 1 and changes["setting_b"] == "x"
+    assert numeric == {}
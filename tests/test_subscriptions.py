@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from app import mqtt_client
+
+
+def update(version, changes=None, removed=(), topics=None):
+    return {"type": "update", "version": version, "topics": topics or list(changes or ()),
+            "changes": changes or {}, "removed": tuple(removed), "received_at": float(version or 0)}
+
+
+def drain(queue):
+    async def get_all():
+        return [await queue.get() for _ in range(queue.qsize())]
+    return asyncio.run(get_all())
+
+
+def test_merge_updates_neuester_wert_und_entfernte_keys():
+    older = update(1, {"a": "1", "b": "1"}, removed=("c", "d"))
+    newer = update(2, {"c": "2", "a": "2"}, removed=("b",))
+    merged = mqtt_client.merge_updates(older, newer)
+    assert merged["version"] == 2
+    assert merged["changes"] == {"a": "2", "c": "2"}
+    assert set(merged["removed"]) == {"b", "d"}
+    assert merged["topics"] == ["a", "b", "c"]
+    # Latenz wird ab der ältesten Nachricht gemessen
+    assert merged["received_at"] == 1.0
+
+
+def test_conflate_fasst_das_letzte_update_zusammen():
+    queue = mqtt_client.Subscription(maxsize=2, overflow="conflate")
+    for version in (1, 2, 3):
+        queue.put_nowait(update(version, {"a": str(version), f"k{version}": "x"}))
+    assert queue.qsize() == 2
+    assert queue.conflated == 1 and queue.dropped == 0
+    assert not queue.needs_resync()
+    first, last = drain(queue)
+    assert first["version"] == 1
+    assert last["version"] == 3
+    assert last["changes"] == {"a": "3", "k2": "x", "k3": "x"}
+
+
+def test_drop_oldest_verwirft_und_meldet_resync_einmal():
+    queue = mqtt_client.Subscription(maxsize=2, overflow="drop_oldest")
+    for version in (1, 2, 3):
+        queue.put_nowait(update(version, {"a": str(version)}))
+    assert queue.dropped == 1
+    assert [item["version"] for item in drain(queue)] == [2, 3]
+    assert queue.needs_resync()
+    assert not queue.needs_resync()
+
+
+def test_disconnect_schliesst_die_subscription():
+    queue = mqtt_client.Subscription(maxsize=2, overflow="disconnect")
+    for version in (1, 2, 3, 4):
+        queue.put_nowait(update(version, {"a": str(version)}))
+    assert queue.closed
+    assert queue.qsize() == 0
+    assert queue.dropped == 3
+    with pytest.raises(mqtt_client.SubscriptionClosed):
+        asyncio.run(queue.get())
+
+
+def test_unbekannte_overflow_policy():
+    with pytest.raises(ValueError):
+        mqtt_client.Subscription(overflow="ignore")
+
+
+def test_gefilterte_subscription_bekommt_nur_passende_keys():
+    hub = mqtt_client.UpdateHub()
+    everything = hub.subscribe()
+    ext = hub.subscribe(("ext1/#",))
+    hub.publish(update(1, {"ext1/temperature": "1", "status": "ok"}, removed=("ext1/humidity", "innen")))
+    assert drain(everything)[0]["changes"] == {"ext1/temperature": "1", "status": "ok"}
+    filtered, = drain(ext)
+    assert filtered["changes"] == {"ext1/temperature": "1"}
+    assert filtered["removed"] == ("ext1/humidity",)
+    hub.unsubscribe(ext)
+    hub.publish(update(2, {"ext1/temperature": "2"}))
+    assert ext.qsize() == 0
+
+
+@pytest.fixture
+def device(monkeypatch):
+    monkeypatch.setattr(mqtt_client, "CHANGE_LOG_SIZE", 3)
+    return mqtt_client.Device("test", "devices/test/")
+
+
+def test_changes_since_liefert_verpasste_change_sets(device):
+    for value in "123":
+        device.commit(update(None, {"a": value}))
+    assert device.store.version == 3
+    assert [item["version"] for item in device.changes_since(1)] == [2, 3]
+    assert device.changes_since(3) == []
+    # Version aus der Zukunft (z.B. anderer Prozess): nicht fortsetzbar
+    assert device.changes_since(4) is None
+
+
+def test_changes_since_erkennt_luecken_im_change_log(device):
+    for value in "12345":
+        device.commit(update(None, {"a": value}))
+    # Nur die letzten drei Change-Sets (3..5) liegen noch im change_log
+    assert [item["version"] for item in device.changes_since(2)] == [3, 4, 5]
+    assert device.changes_since(1) is None
+    device.change_log.clear()
+    assert device.changes_since(4) is None
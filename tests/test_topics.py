@@ -0,0 +1,114 @@
+import pytest
+
+from app.topics import TopicTrie, filter_trie, is_valid_filter, is_valid_topic
+
+
+@pytest.fixture
+def trie():
+    trie = TopicTrie()
+    for topic_filter in ("ext1/temperature", "ext1/+", "+/humidity", "ext1/#", "#", "$SYS/#", "a/+/c"):
+        trie.insert(topic_filter, topic_filter)
+    return trie
+
+
+@pytest.mark.parametrize("topic, expected", [
+    ("ext1/temperature", {"ext1/temperature", "ext1/+", "ext1/#", "#"}),
+    ("ext1/humidity", {"ext1/+", "+/humidity", "ext1/#", "#"}),
+    ("ext1/a/b", {"ext1/#", "#"}),
+    ("innen", {"#"}),
+    ("a/b/c", {"a/+/c", "#"}),
+    ("a/b", {"#"}),
+    ("a/b/c/d", {"#"}),
+])
+def test_match_mit_wildcards(trie, topic, expected):
+    assert sorted(trie.match(topic)) == sorted(expected)
+
+
+def test_mehrebenen_wildcard_passt_auf_die_elternebene(trie):
+    # 'ext1/#' passt auch auf 'ext1' selbst, 'ext1/+' dagegen nicht
+    assert sorted(trie.match("ext1")) == ["#", "ext1/#"]
+
+
+@pytest.mark.parametrize("topic, expected", [
+    ("$SYS/broker/uptime", ["$SYS/#"]),
+    ("$SYS", ["$SYS/#"]),
+    ("$share/humidity", []),
+])
+def test_wildcards_am_anfang_passen_nicht_auf_dollar_topics(trie, topic, expected):
+    assert trie.match(topic) == expected
+
+
+def test_leere_ebenen_sind_eigene_ebenen():
+    trie = filter_trie(("a/+",))
+    assert trie.matches("a/")
+    assert not trie.matches("a")
+    assert not trie.matches("/a")
+
+
+def test_remove_entfernt_wert_und_leere_aeste(trie):
+    size = len(trie)
+    trie.remove("a/+/c", "a/+/c")
+    assert len(trie) == size - 1
+    assert trie.match("a/b/c") == ["#"]
+    assert "a" not in trie._root.children
+    # Gemeinsame Präfixe bleiben erhalten
+    trie.remove("ext1/temperature", "ext1/temperature")
+    assert "ext1" in trie._root.children
+    assert "temperature" not in trie._root.children["ext1"].children
+    assert sorted(trie.match("ext1/temperature")) == ["#", "ext1/#", "ext1/+"]
+
+
+def test_remove_unbekannter_filter_oder_wert(trie):
+    size = len(trie)
+    trie.remove("gibt/es/nicht", "x")
+    trie.remove("ext1/+", "anderer Wert")
+    assert len(trie) == size
+    assert "ext1/+" in trie.match("ext1/x")
+
+
+def test_remove_nur_einen_von_mehreren_werten():
+    trie = TopicTrie()
+    trie.insert("ext1/+", 1)
+    trie.insert("ext1/+", 2)
+    trie.remove("ext1/+", 1)
+    assert trie.match("ext1/x") == [2]
+    trie.remove("ext1/+", 2)
+    assert len(trie) == 0
+    assert trie._root.children == {}
+
+
+def test_insert_ungueltiger_filter():
+    with pytest.raises(ValueError):
+        TopicTrie().insert("a/#/b", True)
+
+
+@pytest.mark.parametrize("topic_filter, valid", [
+    ("a/b", True),
+    ("+", True),
+    ("#", True),
+    ("a/+/c", True),
+    ("a/#", True),
+    ("$SYS/#", True),
+    ("a//b", True),
+    ("", False),
+    ("a/#/b", False),
+    ("a#", False),
+    ("a/b+", False),
+    ("+a/b", False),
+])
+def test_is_valid_filter(topic_filter, valid):
+    assert is_valid_filter(topic_filter) is valid
+
+
+@pytest.mark.parametrize("topic, valid", [
+    ("ext1/temperature", True),
+    ("", False),
+    ("ext1/+", False),
+    ("ext1/#", False),
+    ("ext1\0", False),
+    ("a" * 65535, True),
+    ("a" * 65536, False),
+    ("ä" * 32768, False),
+])
+def test_is_valid_topic(topic, valid):
+    assert is_valid_topic(topic) is valid